@@ -0,0 +1,308 @@
+import asyncio
+import datetime
+import json
+import os
+import random
+import time
+import weakref
+from json import JSONDecodeError
+
+import aiohttp
+
+import train_api
+
+
+class AsyncRailClient:
+    """Asyncio HTTP client for the rail server, keeping pooled keep-alive connections between calls.
+
+    The session is created lazily inside the running event loop, call :meth:`close` before the loop is closed. Like
+    `train_api.RailClient`, each endpoint has its own circuit breaker, route lookups are retried with a jittered
+    exponential backoff and voucher orders are never retried.
+
+    Attributes:
+        pool_size (number): the maximum amount of open connections to the rail server.
+        proxy (str): Optional. https proxy url, by default taken from the `RAIL_PROXY` env var.
+        routes_timeout (number): Optional. total timeout in seconds of a route lookup.
+        voucher_timeout (number): Optional. total timeout in seconds of a voucher order.
+        routes_retries (number): Optional. how many times a failed route lookup is retried.
+        retry_backoff (number): Optional. base seconds to wait before a retry, doubled on every retry.
+        failure_threshold (number): Optional. consecutive failures of an endpoint that open its circuit.
+        reset_timeout (number): Optional. seconds an open circuit fails fast before trying the endpoint again.
+    """
+    DEFAULT_POOL_SIZE = 1000
+
+    def __init__(self,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 proxy=None,
+                 routes_timeout=30,
+                 voucher_timeout=60,
+                 routes_retries=2,
+                 retry_backoff=0.5,
+                 failure_threshold=5,
+                 reset_timeout=30):
+        if proxy is None:
+            proxy = os.getenv('RAIL_PROXY')
+
+        self.pool_size = pool_size
+        self.proxy = proxy
+        self.routes_timeout = aiohttp.ClientTimeout(total=routes_timeout, connect=5)
+        self.voucher_timeout = aiohttp.ClientTimeout(total=voucher_timeout, connect=5)
+        self.routes_retries = routes_retries
+        self.retry_backoff = retry_backoff
+        self.routes_breaker = train_api.CircuitBreaker('GetRoutes', failure_threshold, reset_timeout)
+        self.voucher_breaker = train_api.CircuitBreaker('ReservedPlaceHandler', failure_threshold, reset_timeout)
+        self.retries = 0
+        self._session = None
+        # event loop to the requests of the same day currently running on it, shared by concurrent callers
+        self._in_flight = weakref.WeakKeyDictionary()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+
+        return self._session
+
+    @property
+    def in_flight(self):
+        """The requests running on the current event loop, a task can be awaited only from the loop running it."""
+        return self._in_flight.setdefault(asyncio.get_event_loop(), {})
+
+    async def get_text(self, url):
+        return await self._call(self.routes_breaker, self.session.get, url, self.routes_retries,
+                                timeout=self.routes_timeout)
+
+    async def post_text(self, url, data):
+        return await self._call(self.voucher_breaker, self.session.post, url, 0, data=data,
+                                timeout=self.voucher_timeout)
+
+    async def _call(self, breaker, method, url, retries, **kwargs):
+        """Call an endpoint through its circuit breaker, retrying request errors (e.g. connection errors and timeouts)
+        and server errors.
+
+        Returns:
+            str. the body of the response.
+
+        Raises:
+            RailServerUnavailableError: the circuit is open or all the attempts failed.
+        """
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                self.retries += 1
+                # Full jitter, so the retries of many callers do not hit the server at the same moment
+                await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** (attempt - 1)))
+
+            breaker.before_call()
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                async with method(url, proxy=self.proxy, **kwargs) as res:
+                    text = await res.text()
+
+                if res.status < 500:
+                    outcome = 'ok'
+
+                else:
+                    error = aiohttp.ClientResponseError(res.request_info, res.history, status=res.status,
+                                                        message=f'{breaker.name} responded with status {res.status}')
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+            finally:
+                # every outcome is recorded, even unexpected errors, so a half open circuit does not wait for a trial
+                # call that already ended
+                duration = time.perf_counter() - start
+                train_api.rail_request_seconds.labels(endpoint=breaker.name, outcome=outcome).observe(duration)
+                if outcome == 'ok':
+                    breaker.record_success()
+
+                else:
+                    breaker.record_failure()
+
+            if outcome == 'ok':
+                return text
+
+        raise train_api.RailServerUnavailableError(f'{breaker.name} failed after {retries + 1} attempts') from error
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+client = AsyncRailClient()
+
+
+async def _fetch_routes(origin_station_id, dest_station_id, date: datetime.date):
+    text = await client.get_text(train_api._routes_url(origin_station_id, dest_station_id, date))
+    try:
+        body = json.loads(text)
+
+    except JSONDecodeError:
+        raise AttributeError('No JSON received. some of the request parameters might be wrong')
+
+    return train_api.DayTimetable(train_api._iter_routes_body(body))
+
+
+async def _load_routes(origin_station_id, dest_station_id, date: datetime.date):
+    """Load the routes of a day from the local timetable store, or from the rail server if it is not stored."""
+    # the store is sqlite, read and written on the loop's default executor
+    loop = asyncio.get_event_loop()
+    store = train_api.timetable_store
+    if store is not None:
+        timetable = await loop.run_in_executor(None, store.load, origin_station_id, dest_station_id, date)
+        if timetable is not None:
+            return timetable
+
+    timetable = await _fetch_routes(origin_station_id, dest_station_id, date)
+    if store is not None:
+        await loop.run_in_executor(None, store.save, origin_station_id, dest_station_id, date, timetable)
+
+    return timetable
+
+
+async def get_day_timetable(origin_station_id, dest_station_id, date: datetime.date = None):
+    """Get the timetable of all the routes of the day, see `train_api.get_day_timetable`.
+
+    Returns:
+        train_api.DayTimetable. the routes and trains of the day.
+    """
+    key = train_api._routes_cache_key(origin_station_id, dest_station_id, date)
+    timetable = train_api.routes_cache.peek(key)
+    if timetable is not None:
+        return timetable
+
+    in_flight = client.in_flight
+    task = in_flight.get(key)
+    if task is None:
+        task = in_flight[key] = asyncio.ensure_future(_load_routes(*key))
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+
+    timetable = await asyncio.shield(task)
+    train_api.routes_cache.put(key, timetable)
+    return timetable
+
+
+async def get_all_routes_for_today(origin_station_id, dest_station_id, date: datetime.date = None):
+    """Get a list of all the routes of the day, from 00:00 to 00:00.
+
+    Args:
+        origin_station_id (number): the origin station id.
+        dest_station_id (number): the destination station id.
+        date (datetime.datetime): Optional. the date of the day, the time does not matter. if not supplied the date
+            is today.
+
+    Returns:
+        list. list of Route objects.
+
+    Raises:
+        AttributeError: If some of the parameters are wrong.
+        ValueError: The result from the server is missing.
+    """
+    return list((await get_day_timetable(origin_station_id, dest_station_id, date)).routes)
+
+
+async def get_all_trains_for_today(origin_station_id, dest_station_id, date: datetime.date = None):
+    """Get a list of all the trains that were available today, from 00:00 to 00:00.
+
+    Args:
+        origin_station_id (number): the origin station id.
+        dest_station_id (number): the destination station id.
+        date (datetime.datetime): Optional. the date of the day, the time does not matter. if not supplied the date
+            is today.
+
+    Returns:
+        list. list of Train objects.
+
+    Raises:
+        AttributeError: If some of the parameters are wrong.
+        ValueError: The result from the server is missing.
+    """
+    return list((await get_day_timetable(origin_station_id, dest_station_id, date)).trains)
+
+
+async def get_available_trains(origin_station_id, dest_station_id, date: datetime.datetime = None):
+    """Get a list of all the trains that are available from the current date and on.
+
+    Args:
+        origin_station_id (number): the origin station id.
+        dest_station_id (number): the destination station id.
+        date (datetime.datetime): Optional. the day and time to get ongoing trains and on. if not supplied the date
+            is now.
+
+    Returns:
+        list. list of Train objects.
+    """
+    if date is None:
+        date = datetime.datetime.now()
+
+    return (await get_day_timetable(origin_station_id, dest_station_id, date.date())).trains_after(date)
+
+
+async def get_first_available_train(origin_station_id, dest_station_id, date):
+    """Get first train available.
+
+    Args:
+        origin_station_id (number): the origin station id.
+        dest_station_id (number): the destination station id.
+        date (datetime.datetime): Optional. the day and time to get ongoing trains and on. if not supplied the date
+            is now.
+
+    Returns:
+        Train. the first available train for that date.
+
+    Raises:
+        RuntimeError: if no trains were available for that date.
+    """
+    if date is None:
+        date = datetime.datetime.now()
+
+    timetable = await get_day_timetable(origin_station_id, dest_station_id, date.date())
+    return train_api._first_available_train(timetable, date)
+
+
+async def request_train(user_id,
+                        email='',
+                        origin_station_id=None,
+                        dest_station_id=None,
+                        time_for_request: datetime.datetime = None,
+                        train_instance=None,
+                        image_dest=None):
+    """Get a QR code for a specific train, see `train_api.request_train` for the arguments.
+
+    Raises:
+        AttributeError: some arguments must be wrong.
+        ValueError: No barcode image received.
+        RuntimeError: some other error.
+    """
+    if train_instance is None and (origin_station_id is None or dest_station_id is None or time_for_request is None):
+        raise ValueError("Either train_json should be supplied or (origin_station_id, dest_station_id, "
+                         "time_for_request)")
+
+    if train_instance is not None:
+        train = train_instance
+
+    else:
+        train = await get_first_available_train(origin_station_id, dest_station_id, time_for_request)
+
+    text = await client.post_text(train_api._voucher_url(user_id, email),
+                                  data=json.dumps(train_api._voucher_payload(train)))
+    try:
+        body = json.loads(text)
+
+    except JSONDecodeError:
+        raise AttributeError('No JSON received, some of the arguments must be wrong')
+
+    return train_api._save_barcode_image(train_api._barcode_image_from_voucher_body(body), image_dest)
+
+
+async def request_route(user_id, route, email=''):
+    """Get a QR code for every train of a route, see `train_api.request_route`.
+
+    Returns:
+        list. for every train of the route (in order), the QR code image (io.BytesIO) or the exception raised while
+        ordering it.
+    """
+    return await asyncio.gather(*(request_train(user_id, email=email, train_instance=train) for train in route.trains),
+                                return_exceptions=True)
@@ -0,0 +1,234 @@
+import datetime
+import logging
+import threading
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import train_api
+from train_api import Train
+from utils import decode_firebase_key
+from utils import encode_firebase_key
+
+logger = logging.getLogger(__name__)
+
+auto_orders = metrics.Counter('auto_orders', 'Scheduled voucher orders by outcome', ('outcome',))
+
+WEEKDAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+
+
+def parse_weekdays(text):
+    """Parse weekday names (e.g. "sun, mon tue") into a sorted list of `datetime.date.weekday` numbers.
+
+    Raises:
+        ValueError: if one of the names is not a weekday.
+    """
+    weekdays = set()
+    for name in text.replace(',', ' ').lower().split():
+        if name[:3] not in WEEKDAY_NAMES:
+            raise ValueError(f'{name} is not a weekday')
+
+        weekdays.add(WEEKDAY_NAMES.index(name[:3]))
+
+    if len(weekdays) == 0:
+        raise ValueError('No weekdays supplied')
+
+    return sorted(weekdays)
+
+
+def printable_weekdays(weekdays):
+    return ', '.join(WEEKDAY_NAMES[weekday].capitalize() for weekday in weekdays)
+
+
+class AutoOrderScheduler:
+    """Order the vouchers of the users' scheduled saved trains, ahead of the trains departure.
+
+    The schedules are kept in firebase under `/schedules/<user id>/<encoded saved train label>`. Every
+    `plan_interval` seconds the orders due until the next run are queued on the dispatcher's JobQueue. Each order runs
+    `lead_minutes` before its train plus a stable per user offset of up to `spread_window` seconds, so the orders of a
+    popular train are spread over the window instead of all running at the same moment, and at most
+    `max_concurrency` orders run at once. An order runs only if its schedule still exists when it is due. The trains
+    are validated against the routes cache, so the orders of a pair share a fetch of the day.
+
+    Attributes:
+        firebase (firebase.FirebaseApplication): the db the schedules are kept in.
+        dispatcher (telegram.ext.Dispatcher): the bot's dispatcher, for its bot, JobQueue and users data.
+        spread_window (number): Optional. seconds before their lead time the orders are spread over.
+        max_concurrency (number): Optional. the maximum amount of orders running at the same time.
+        plan_interval (number): Optional. seconds between the runs queueing the next orders.
+    """
+    SCHEDULES_KEY = 'schedules'
+
+    def __init__(self, firebase, dispatcher, spread_window=30 * 60, max_concurrency=4, plan_interval=10 * 60):
+        self.firebase = firebase
+        self.dispatcher = dispatcher
+        self.spread_window = spread_window
+        self.max_concurrency = max_concurrency
+        self.plan_interval = plan_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='auto-order')
+        self._planned = set()
+        self._lock = threading.Lock()
+        self._schedules = defaultdict(dict)
+        for user_id, schedules in (self.firebase.get(f'/{self.SCHEDULES_KEY}', None) or {}).items():
+            self._schedules[int(user_id)].update({decode_firebase_key(key): schedule
+                                                  for key, schedule in schedules.items()})
+
+    def start(self):
+        """Start planning the orders periodically on the dispatcher's JobQueue."""
+        self.dispatcher.job_queue.run_repeating(self.plan, interval=self.plan_interval, first=0)
+
+    def schedules_of(self, user_id):
+        """Return the schedules of a user, a dict of saved train label to schedule."""
+        with self._lock:
+            return dict(self._schedules.get(user_id, {}))
+
+    def set_schedule(self, user_id, chat_id, train_label, train: Train, weekdays, lead_minutes):
+        """Order a saved train every chosen weekday, `lead_minutes` before it departs.
+
+        Args:
+            user_id (number): the telegram user id.
+            chat_id (number): the chat the vouchers are sent to.
+            train_label (str): the label of the saved train.
+            train (Train): the saved train, only its stations and times are used.
+            weekdays (list): `datetime.date.weekday` numbers of the days to order on.
+            lead_minutes (number): how many minutes before the departure to order the voucher.
+        """
+        schedule = {'chat_id': chat_id,
+                    'train': train.to_dict(),
+                    'weekdays': list(weekdays),
+                    'lead_minutes': lead_minutes,
+                    'last_ordered': ''}
+        # kept in memory only once written, so a failed write does not leave a schedule that is lost on restart
+        self._write_schedule(user_id, train_label, schedule)
+        with self._lock:
+            self._schedules[user_id][train_label] = schedule
+
+    def remove_schedule(self, user_id, train_label):
+        with self._lock:
+            if train_label not in self._schedules.get(user_id, {}):
+                return
+
+        # writing null deletes the key
+        self._write_schedule(user_id, train_label, None)
+        with self._lock:
+            self._schedules.get(user_id, {}).pop(train_label, None)
+
+    def _write_schedule(self, user_id, train_label, schedule):
+        # the labels may contain characters firebase does not allow in keys (e.g. '.' in 'עפולה ר.איתן')
+        self.firebase.patch(f'/{self.SCHEDULES_KEY}/{user_id}', {encode_firebase_key(train_label): schedule})
+
+    def plan(self, context=None):
+        """Queue the orders due before the next run, can be used as a JobQueue callback.
+
+        Orders whose time already passed (e.g. the bot was down) are queued immediately as long as their train has
+        not departed yet.
+        """
+        now = datetime.datetime.now()
+        today = now.date()
+        plan_end = now + datetime.timedelta(seconds=self.plan_interval)
+        batches = defaultdict(list)
+        with self._lock:
+            self._planned = {key for key in self._planned if key[2] >= today}
+            for user_id, schedules in self._schedules.items():
+                for train_label, schedule in schedules.items():
+                    for date in self._order_dates(today):
+                        order = self._plan_order(user_id, train_label, schedule, date, now, plan_end)
+                        if order is not None:
+                            delay, key = order
+                            self._planned.add(key)
+                            # orders due in the same minute run from a single job
+                            batches[int(delay // 60)].append(key)
+
+        job_queue = self.dispatcher.job_queue
+        for minute, orders in batches.items():
+            job_queue.run_once(self._run_batch, when=minute * 60, context=orders)
+
+        logger.info(f"Planned {sum(len(orders) for orders in batches.values())} scheduled orders "
+                    f"in {len(batches)} batches")
+
+    def _order_dates(self, today):
+        # the lead time is shorter than a day, so with the spread an order may be due up to two days before its train
+        # (e.g. a train just after midnight)
+        return [today + datetime.timedelta(days=days) for days in range(3)]
+
+    def _plan_order(self, user_id, train_label, schedule, date, now, plan_end):
+        """Return the seconds until the order of the schedule's train on the date and its key, or None if it is not
+        due before `plan_end`."""
+        key = (user_id, train_label, date)
+        if date.weekday() not in schedule['weekdays'] or schedule['last_ordered'] == str(date) or \
+                key in self._planned:
+            return None
+
+        departure = datetime.datetime.combine(date, Train.from_json(schedule['train']).departure_datetime.time())
+        order_time = departure - datetime.timedelta(minutes=schedule['lead_minutes'],
+                                                    seconds=self._spread_offset(user_id, train_label))
+        if departure <= now or order_time >= plan_end:
+            return None
+
+        return max((order_time - now).total_seconds(), 0), key
+
+    def _spread_offset(self, user_id, train_label):
+        # stable across restarts, so a schedule keeps its place in the window
+        return zlib.crc32(f'{user_id}:{train_label}'.encode('utf8')) % (self.spread_window + 1)
+
+    def _run_batch(self, context):
+        for order in context.job.context:
+            self._executor.submit(self._order, *order)
+
+    def _order(self, user_id, train_label, date):
+        with self._lock:
+            schedule = self._schedules.get(user_id, {}).get(train_label)
+            # the schedule may have been removed or changed since the order was planned
+            if schedule is None or date.weekday() not in schedule['weekdays'] or \
+                    schedule['last_ordered'] == str(date):
+                logger.info(f"Skipping the scheduled order of {train_label} for {user_id}, it is not scheduled anymore")
+                return
+
+            schedule = dict(schedule)
+
+        bot = self.dispatcher.bot
+        chat_id = schedule['chat_id']
+        saved_train = Train.from_json(schedule['train'])
+        departure = datetime.datetime.combine(date, saved_train.departure_datetime.time())
+        try:
+            key = (saved_train.origin_station_id, saved_train.destination_station_id, departure.date())
+            # through the routes cache, so the trains are minutes old at most and orders of a pair share the fetch
+            timetable = train_api.get_day_timetable(*key)
+            train = next((train for train in timetable.trains_departing_at(departure)
+                          if train.arrival_time == saved_train.arrival_time), None)
+            if train is None:
+                auto_orders.labels(outcome='not_found').inc()
+                bot.send_message(chat_id, f"Scheduled train {train_label} could'nt be found on {date}, "
+                                          f"please check the official site.")
+                return
+
+            user_data = self.dispatcher.user_data[user_id]
+            qr_image = train_api.request_train(user_id=user_data['id'],
+                                               email=user_data.get('email', ''),
+                                               train_instance=train)
+            bot.send_message(chat_id, f'Your scheduled voucher:\n{train}')
+            bot.send_photo(chat_id, qr_image)
+
+        except Exception as e:
+            logger.exception(f"Scheduled order of {train_label} for {user_id} failed")
+            auto_orders.labels(outcome='failed').inc()
+            bot.send_message(chat_id, f'Failed to order your scheduled train {train_label} ({e}), '
+                                      f'please order it manually.')
+            return
+
+        auto_orders.labels(outcome='ordered').inc()
+        self._mark_ordered(user_id, train_label, departure.date())
+
+    def _mark_ordered(self, user_id, train_label, date):
+        with self._lock:
+            schedule = self._schedules.get(user_id, {}).get(train_label)
+            if schedule is None:
+                return
+
+            schedule = dict(schedule, last_ordered=str(date))
+
+        self._write_schedule(user_id, train_label, schedule)
+        with self._lock:
+            if train_label in self._schedules.get(user_id, {}):
+                self._schedules[user_id][train_label]['last_ordered'] = str(date)
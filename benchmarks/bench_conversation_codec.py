@@ -0,0 +1,76 @@
+"""Compare the conversation key codecs of utils before and after the compact "chat:user" keys.
+
+Run from the repository root: python benchmarks/bench_conversation_codec.py [--entries 1000000]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils  # noqa: E402
+
+CONVERSATION_NAME = 'main_conversation'
+
+
+def old_enocde_conversations(conversations):
+    tmp = {}
+    for handler, states in conversations.items():
+        tmp[handler] = {}
+        for key, state in states.items():
+            key_in_list_format = json.dumps(key)
+            key_in_tuple_format = key_in_list_format.replace("[", "(").replace("]", ")")
+            tmp[handler][key_in_tuple_format] = state
+    return tmp
+
+
+def old_decode_conversations(conversations_dict):
+    conversations = {}
+    for handler, states in conversations_dict.items():
+        conversations[handler] = {}
+        for key, state in states.items():
+            json_in_list_format = key.replace("(", "[").replace(")", "]")
+            conversations[handler][tuple(json.loads(json_in_list_format))] = state
+    return conversations
+
+
+def report(name, seconds, entries):
+    print(f"{name:<40} {seconds:8.3f}s {seconds / entries * 1e9:8.0f} ns/entry")
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=1000000)
+    parser.add_argument('--changed', type=float, default=0.01, help='ratio of the entries changed between saves')
+    args = parser.parse_args()
+
+    conversations = {CONVERSATION_NAME: {(user_id, user_id): 2 for user_id in range(args.entries)}}
+    changed_keys = [(CONVERSATION_NAME, (user_id, user_id))
+                    for user_id in range(0, args.entries, max(int(1 / args.changed), 1))]
+
+    seconds, old_encoded = timed(old_enocde_conversations, conversations)
+    report('old encode', seconds, args.entries)
+    seconds, encoded = timed(utils.enocde_conversations, conversations)
+    report('new encode', seconds, args.entries)
+    seconds, _ = timed(utils.enocde_conversations, conversations, changed_keys)
+    report(f'new encode of the changed {args.changed:.0%}', seconds, args.entries)
+
+    seconds, old_decoded = timed(old_decode_conversations, old_encoded)
+    report('old decode', seconds, args.entries)
+    seconds, decoded = timed(utils.decode_conversations, encoded)
+    report('new decode', seconds, args.entries)
+    seconds, legacy_decoded = timed(utils.decode_conversations, old_encoded)
+    report('new decode of legacy keys', seconds, args.entries)
+    assert old_decoded == decoded == legacy_decoded == conversations
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Compare the flush and load times of the firebase and the SQLite persistence.
+
+FirebasePersistence talks to the local stub firebase server (with a configurable round trip latency), and
+SqlitePersistence to a database in a temporary directory.
+
+Run from the repository root: python benchmarks/bench_persistence_backends.py [--sizes 1000 10000] [--latency 0.02]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firebasepersistance import FirebasePersistence  # noqa: E402
+from sqlitepersistance import SqlitePersistence  # noqa: E402
+from stub_firebase_server import start_stub_server  # noqa: E402
+
+CONVERSATION_NAME = 'main_conversation'
+SAVED_TRAIN = {'DepartureTime': '05/10/2020 07:12:00',
+               'ArrivalTime': '05/10/2020 07:58:00',
+               'OrignStation': 3700,
+               'DestinationStation': 2100,
+               'Trainno': 119,
+               'DestPlatform': 1,
+               'Platform': 3,
+               'IsFullTrain': False}
+
+
+def user_record(user_id):
+    return {'id': str(100000000 + user_id),
+            'email': f'user{user_id}@example.com',
+            'saved_trains': {f'train {i}': dict(SAVED_TRAIN, Trainno=i) for i in range(2)}}
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def update_users(persistence, user_ids, version):
+    user_data = persistence.get_user_data()
+    for user_id in user_ids:
+        if user_id in user_data:
+            # in place, like the handlers change context.user_data
+            user_data[user_id]['version'] = version
+
+        else:
+            user_data[user_id] = dict(user_record(user_id), version=version)
+
+        persistence.update_conversation(CONVERSATION_NAME, (user_id, user_id), 2)
+
+
+def load_users(persistence, user_ids):
+    for user_id in user_ids:
+        persistence.get_user_data()[user_id]
+
+
+def benchmark(name, create_persistence, users, loads):
+    persistence = create_persistence()
+    update_users(persistence, range(users), 1)
+    full_flush = timed(persistence.flush)
+
+    changed = range(0, users, 100)
+    update_users(persistence, changed, 2)
+    incremental_flush = timed(persistence.flush)
+
+    start = time.perf_counter()
+    persistence = create_persistence()
+    persistence.get_conversations(CONVERSATION_NAME)
+    startup = time.perf_counter() - start
+
+    loaded = range(0, users, max(users // loads, 1))
+    user_load = timed(lambda: load_users(persistence, loaded)) / len(loaded)
+
+    print(f"{name:<9} {users:>7} {full_flush:>11.3f} {incremental_flush:>11.3f} {startup:>9.3f} "
+          f"{user_load * 1e3:>12.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds of every firebase round trip')
+    parser.add_argument('--loads', type=int, default=200, help='how many users to load after a restart')
+    args = parser.parse_args()
+
+    server = start_stub_server(latency=args.latency)
+    print(f"{'backend':<9} {'users':>7} {'flush s':>11} {'1% flush s':>11} {'startup s':>9} {'user load ms':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        for users in args.sizes:
+            db_path = os.path.join(directory, f'{users}.db')
+            benchmark('firebase', lambda: FirebasePersistence(server.url, max_cached_users=users), users, args.loads)
+            benchmark('sqlite', lambda: SqlitePersistence(db_path, max_cached_users=users), users, args.loads)
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
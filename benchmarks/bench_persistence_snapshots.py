@@ -0,0 +1,120 @@
+"""Compare the persistence startup before and after the lazy, copy-free user data and conversations.
+
+The old persistence downloaded the whole user data tree, decoded it and handed the dispatcher a deep copy of it (and
+of the conversations). The new one hands the dispatcher a dict that fetches each user when it is first used, and a
+copy-on-write view of the conversations. Both read from an in-memory stand-in of firebase.
+
+Run from the repository root: python benchmarks/bench_persistence_snapshots.py [--sizes 10000 100000 1000000]
+"""
+import argparse
+import copy
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from persistence import CopyOnWriteDict  # noqa: E402
+from persistence import LazyDict  # noqa: E402
+from utils import decode_conversations  # noqa: E402
+
+CONVERSATION_NAME = 'main_conversation'
+SAVED_TRAIN = {'DepartureTime': '05/10/2020 07:12:00',
+               'ArrivalTime': '05/10/2020 07:58:00',
+               'OrignStation': 3700,
+               'DestinationStation': 2100,
+               'Trainno': 119,
+               'DestPlatform': 1,
+               'Platform': 3,
+               'IsFullTrain': False}
+
+
+class InMemoryFirebase:
+    """Stand-in of `firebase.FirebaseApplication.get` over a dict tree."""
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def get(self, url, name):
+        node = self.tree
+        for part in url.strip('/').split('/') + ([] if name is None else [name]):
+            node = node.get(part) if isinstance(node, dict) else None
+
+        return node
+
+
+def synthetic_tree(users):
+    """Build the firebase tree of `users` users, every fifth one with two saved trains."""
+    user_data = {}
+    conversations = {}
+    for user_id in range(users):
+        saved_trains = {} if user_id % 5 else {f'train {i}': dict(SAVED_TRAIN, Trainno=i) for i in range(2)}
+        user_data[str(user_id)] = {'id': str(100000000 + user_id), 'email': '', 'saved_trains': saved_trains}
+        conversations[f'({user_id}, {user_id})'] = 2
+
+    return {'user_data': user_data, 'conversations': {CONVERSATION_NAME: conversations}}
+
+
+def old_startup(db, active_users):
+    user_data = db.get('/user_data', None)
+    # decode_user_chat_data_from_json(json.dumps(...)) of python-telegram-bot
+    user_data = defaultdict(dict, {int(user_id): data for user_id, data in json.loads(json.dumps(user_data)).items()})
+    conversations = decode_conversations(db.get('/conversations', None))
+    dispatcher_user_data = copy.deepcopy(user_data)
+    dispatcher_conversations = copy.deepcopy(conversations.get(CONVERSATION_NAME, {}))
+    for user_id in active_users:
+        dispatcher_user_data[user_id]
+        dispatcher_conversations.get((user_id, user_id))
+
+    return user_data, conversations, dispatcher_user_data, dispatcher_conversations
+
+
+def new_startup(db, active_users):
+    user_data = LazyDict(lambda user_id: db.get('/user_data', str(user_id)), max_size=10000,
+                         is_dirty=lambda user_id: False)
+    conversations = decode_conversations(db.get('/conversations', None))
+    dispatcher_conversations = CopyOnWriteDict(conversations.setdefault(CONVERSATION_NAME, {}))
+    for user_id in active_users:
+        user_data[user_id]
+        dispatcher_conversations.get((user_id, user_id))
+
+    return user_data, conversations, dispatcher_conversations
+
+
+def measure(startup, db, active_users):
+    gc.collect()
+    start = time.perf_counter()
+    result = startup(db, active_users)
+    seconds = time.perf_counter() - start
+    del result
+
+    gc.collect()
+    tracemalloc.start()
+    result = startup(db, active_users)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return seconds, peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--active', type=float, default=0.01, help='ratio of the users that use the bot')
+    args = parser.parse_args()
+
+    print(f"{'users':>9} {'startup':<6} {'seconds':>9} {'peak MB':>9}")
+    for users in args.sizes:
+        db = InMemoryFirebase(synthetic_tree(users))
+        active_users = range(0, users, max(int(1 / args.active), 1))
+        for name, startup in (('old', old_startup), ('new', new_startup)):
+            seconds, peak = measure(startup, db, active_users)
+            print(f"{users:>9} {name:<6} {seconds:>9.3f} {peak:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Compare the station name lookups before and after the precomputed indexes.
+
+Run from the repository root: python benchmarks/bench_station_lookup.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import train_api  # noqa: E402
+
+NUMBER = 20000
+
+
+def old_train_station_name_to_id(train_name):
+    return next(idx for idx, train in train_api.stations_info.items() if train['HE'] == train_name)
+
+
+def old_train_stations():
+    return sorted([train_info['HE'] for train_info in train_api.stations_info.values()])
+
+
+def report(name, seconds):
+    print(f"{name:<45} {seconds / NUMBER * 1e6:8.2f} us/call")
+
+
+def main():
+    # The last station in stations_info is the worst case of the linear scan
+    station_name = train_api.stations_info[6900]['HE']
+
+    report('old name -> id (linear scan)',
+           timeit.timeit(lambda: old_train_station_name_to_id(station_name), number=NUMBER))
+    report('new name -> id (index)',
+           timeit.timeit(lambda: train_api.train_station_name_to_id(station_name), number=NUMBER))
+    report('old membership (sort + list scan)',
+           timeit.timeit(lambda: station_name in old_train_stations(), number=NUMBER))
+    report('new membership (frozenset)',
+           timeit.timeit(lambda: station_name in train_api.station_names_set, number=NUMBER))
+    for query in ('haif', 'חיפ', 'tel aviv', 'modiin'):
+        report(f'search_stations({query!r})',
+               timeit.timeit(lambda: train_api.search_stations(query), number=NUMBER))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""Compare Train parse / serialize throughput before and after the slotted Train on a GetRoutes payload.
+
+Run from the repository root: python benchmarks/bench_train_parsing.py
+"""
+import datetime
+import json
+import os
+import sys
+import timeit
+from dataclasses import dataclass
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import train_api  # noqa: E402
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'get_routes_3700_2100.json')
+NUMBER = 200
+
+
+@dataclass
+class OldTrain:
+    """The Train implementation before the slotted one, kept for comparison."""
+    departure_datetime: datetime.datetime
+    arrival_datetime: datetime.datetime
+    origin_station_id: int
+    destination_station_id: int
+    train_number: int
+    destination_platform: int
+    platform: int
+    is_full_train: bool
+
+    @classmethod
+    def from_json(cls, train_dict):
+        arrival_time = datetime.datetime.strptime(train_dict["ArrivalTime"], "%d/%m/%Y %H:%M:%S")
+        departure_time = datetime.datetime.strptime(train_dict["DepartureTime"], "%d/%m/%Y %H:%M:%S")
+        return cls(departure_datetime=departure_time,
+                   arrival_datetime=arrival_time,
+                   origin_station_id=int(train_dict["OrignStation"]),
+                   destination_station_id=int(train_dict["DestinationStation"]),
+                   train_number=int(train_dict["Trainno"]),
+                   destination_platform=int(train_dict["DestPlatform"]),
+                   platform=int(train_dict['Platform']),
+                   is_full_train=train_dict["IsFullTrain"])
+
+    def to_dict(self):
+        return {
+            "DepartureTime": self.printable_departure_time,
+            'ArrivalTime': self.printable_arrival_time,
+            'OrignStation': self.origin_station_id,
+            "DestinationStation": self.destination_station_id,
+            "Trainno": self.train_number,
+            "DestPlatform": self.destination_platform,
+            "Platform": self.platform,
+            "IsFullTrain": self.is_full_train
+        }
+
+    def get_printable_travel_time(self):
+        return f"{self.departure_time} - {self.arrival_time}"
+
+    @property
+    def arrival_time(self):
+        return self.arrival_datetime.time().strftime("%H:%M")
+
+    @property
+    def arrival_date(self):
+        return self.arrival_datetime.date().strftime("%d/%m/%Y")
+
+    @property
+    def departure_time(self):
+        return self.departure_datetime.time().strftime("%H:%M")
+
+    @property
+    def departure_date(self):
+        return self.departure_datetime.date().strftime("%d/%m/%Y")
+
+    @property
+    def printable_arrival_time(self):
+        return f"{self.arrival_date} {self.arrival_time}:00"
+
+    @property
+    def printable_departure_time(self):
+        return f"{self.departure_date} {self.departure_time}:00"
+
+
+def keyboard_round_trip(train_class, train_dicts):
+    """What handle_dest_station and handle_train do with every train of the day."""
+    trains = [train_class.from_json(train_dict) for train_dict in train_dicts]
+    labels = {train.get_printable_travel_time(): train.to_dict() for train in trains}
+    return [train_class.from_json(train_dict) for train_dict in labels.values()]
+
+
+def main():
+    with open(FIXTURE, encoding='utf8') as fixture:
+        body = json.load(fixture)
+
+    train_dicts = [train for route in body['Data']['Routes'] for train in route['Train']]
+    old_trains = [OldTrain.from_json(train_dict) for train_dict in train_dicts]
+    new_trains = [train_api.Train.from_json(train_dict) for train_dict in train_dicts]
+    count = len(train_dicts) * NUMBER
+    print(f"{len(train_dicts)} trains in the payload, {NUMBER} rounds")
+    for name, train_class, trains in (('old', OldTrain, old_trains), ('new', train_api.Train, new_trains)):
+        parse = timeit.timeit(lambda: [train_class.from_json(train_dict) for train_dict in train_dicts],
+                              number=NUMBER)
+        serialize = timeit.timeit(lambda: [train.to_dict() for train in trains], number=NUMBER)
+        round_trip = timeit.timeit(lambda: keyboard_round_trip(train_class, train_dicts), number=NUMBER)
+        print(f"{name}: parse {count / parse:10.0f} trains/s, "
+              f"serialize {count / serialize:10.0f} trains/s, "
+              f"keyboard round trip {count / round_trip:10.0f} trains/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""End to end benchmarks of the train_api hot paths against the local stub rail server.
+
+Reports the throughput and the p50/p95/p99 latency of route lookups, next week scans and voucher orders, with 1, 10
+and 100 concurrent callers.
+
+Run from the repository root: python benchmarks/run_benchmarks.py [--latency 0.05] [--requests 300]
+"""
+import argparse
+import datetime
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import train_api  # noqa: E402
+from stub_rail_server import start_stub_server  # noqa: E402
+
+CONCURRENCY_LEVELS = (1, 10, 100)
+STATION_IDS = sorted(train_api.stations_info)
+
+
+def random_pair(rng):
+    return tuple(rng.sample(STATION_IDS, 2))
+
+
+def route_lookup(rng, executor):
+    """Fetch and parse a whole day from the rail server, as on a routes cache miss."""
+    train_api.refresh_day(*random_pair(rng), datetime.date.today() + datetime.timedelta(days=rng.randrange(7)))
+
+
+def cached_route_lookup(rng, executor):
+    """Get a day through the routes cache, as the bot does for popular pairs."""
+    origin, destination = STATION_IDS[0], STATION_IDS[rng.randrange(1, 5)]
+    list(train_api.get_available_routes(origin, destination))
+
+
+def week_scan(rng, executor):
+    """Find the first of the next 7 days with routes through the routes cache, like the bot's trains list."""
+    origin, destination = random_pair(rng)
+    now = datetime.datetime.now()
+    train_api.get_first_day_with_routes(origin, destination, (now + datetime.timedelta(i) for i in range(7)), executor,
+                                        allow_stale=True)
+
+
+def voucher_order(rng, executor):
+    origin, destination = random_pair(rng)
+    timetable = train_api.get_day_timetable(origin, destination, datetime.date.today() + datetime.timedelta(days=1))
+    train_api.request_train(user_id='123456782', train_instance=rng.choice(timetable.trains))
+
+
+SCENARIOS = {
+    'route lookup': route_lookup,
+    'route lookup (cached)': cached_route_lookup,
+    'week scan': week_scan,
+    'voucher order': voucher_order,
+}
+
+
+def percentile(sorted_values, part):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * part))]
+
+
+def run_scenario(operation, concurrency, requests):
+    """Run `requests` operations from `concurrency` threads.
+
+    Returns:
+        tuple. the throughput (operations / s), the sorted latencies (s) and the amount of failed operations.
+    """
+    counter = itertools.count()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    # Every caller of the week scan fetches a few days at once, like the bot's rail executor
+    executor = ThreadPoolExecutor(max_workers=concurrency * train_api.SCAN_WINDOW)
+
+    def caller(seed):
+        rng = random.Random(seed)
+        while next(counter) < requests:
+            start = time.perf_counter()
+            try:
+                operation(rng, executor)
+
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+                continue
+
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=caller, args=(seed,)) for seed in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+    return len(latencies) / elapsed, sorted(latencies), len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=300, help='operations per scenario and concurrency level')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the stub server delays every response')
+    parser.add_argument('--jitter', type=float, default=0.01, help='random extra seconds of stub latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='part of the stub responses that are 503')
+    parser.add_argument('--routes', type=int, default=None, help='routes in every GetRoutes response')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), action='append', help='run only these scenarios')
+    args = parser.parse_args()
+
+    server = start_stub_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, routes=args.routes)
+    train_api.RAIL_SERVER_URL = server.url
+    train_api.configure_client(pool_size=max(CONCURRENCY_LEVELS) * train_api.SCAN_WINDOW, proxies={})
+    print(f"stub rail server at {server.url}, latency {args.latency}s (+{args.jitter}s), "
+          f"error rate {args.error_rate}, {args.requests} operations per run\n")
+    print(f"{'scenario':<24}{'callers':>8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name in args.scenario or SCENARIOS:
+        for concurrency in CONCURRENCY_LEVELS:
+            train_api.routes_cache.clear()
+            throughput, latencies, errors = run_scenario(SCENARIOS[name], concurrency, args.requests)
+            if len(latencies) == 0:
+                print(f"{name:<24}{concurrency:>8}{'all operations failed':>48}")
+                continue
+
+            print(f"{name:<24}{concurrency:>8}{throughput:>10.1f}"
+                  f"{percentile(latencies, 0.50) * 1000:>10.1f}"
+                  f"{percentile(latencies, 0.95) * 1000:>10.1f}"
+                  f"{percentile(latencies, 0.99) * 1000:>10.1f}"
+                  f"{errors:>8}")
+
+    print(f"\nrail client stats: {train_api.client.stats}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Local stand-in of the firebase realtime database REST API, keeping the db as an in-memory JSON tree.
+
+Supports what the bot uses: GET, PUT and PATCH (including multi-path updates on '/') of `<path>.json`.
+
+Run from the repository root: python benchmarks/stub_firebase_server.py --port 8081 --latency 0.02
+and set `firebase_url` to http://127.0.0.1:8081
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+
+class StubFirebaseServer(ThreadingHTTPServer):
+    """HTTP server answering firebase REST requests from an in-memory tree.
+
+    Attributes:
+        latency (number): seconds every response is delayed by, like the round trip to firebase.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0):
+        super().__init__(address, StubFirebaseRequestHandler)
+        self.latency = latency
+        self.tree = {}
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}"
+
+    def get(self, parts):
+        node = self.tree
+        for part in parts:
+            node = node.get(part) if isinstance(node, dict) else None
+
+        return node
+
+    def set(self, parts, value):
+        if len(parts) == 0:
+            self.tree = value if isinstance(value, dict) else {}
+            return
+
+        node = self.tree
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+
+        if value is None:
+            node.pop(parts[-1], None)
+
+        else:
+            node[parts[-1]] = value
+
+
+def _path_parts(path):
+    path = unquote(urlparse(path).path)
+    if path.endswith('.json'):
+        path = path[:-len('.json')]
+
+    return [part for part in path.split('/') if part != '']
+
+
+class StubFirebaseRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately, do not let the body wait for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        with self.server.lock:
+            body = json.dumps(self.server.get(_path_parts(self.path)))
+
+        self._respond(body)
+
+    def do_PUT(self):
+        value = self._read_json()
+        with self.server.lock:
+            self.server.set(_path_parts(self.path), value)
+
+        self._respond(json.dumps(value))
+
+    def do_PATCH(self):
+        changes = self._read_json()
+        parts = _path_parts(self.path)
+        with self.server.lock:
+            # every key of a patch may be a path of its own (multi-path update)
+            for key, value in changes.items():
+                self.server.set(parts + [part for part in key.split('/') if part != ''], value)
+
+        self._respond(json.dumps(changes))
+
+    def _read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or 'null')
+
+    def _respond(self, body):
+        time.sleep(self.server.latency)
+        body = body.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(host='127.0.0.1', port=0, **kwargs):
+    """Start a stub firebase server on a background thread.
+
+    Returns:
+        StubFirebaseServer. the running server, call `shutdown()` to stop it.
+    """
+    server = StubFirebaseServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every response is delayed by')
+    args = parser.parse_args()
+
+    server = StubFirebaseServer((args.host, args.port), latency=args.latency)
+    print(f"Stub firebase server listening on {server.url}")
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Local stand-in of the rail server, replaying the recorded fixtures of GetRoutes and ReservedPlaceHandler.
+
+Run from the repository root: python benchmarks/stub_rail_server.py --port 8080 --latency 0.05
+and point the bot or the API to it with the env var RAIL_SERVER_URL=http://127.0.0.1:8080
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+ROUTES_FIXTURE = os.path.join(FIXTURES_DIR, 'get_routes_3700_2100.json')
+VOUCHER_FIXTURE = os.path.join(FIXTURES_DIR, 'voucher.json')
+
+ROUTES_PATH = '/apiinfo/api/Plan/GetRoutes'
+VOUCHER_PATH = '/taarif//_layouts/15/SolBox.Rail.FastSale/ReservedPlaceHandler.ashx'
+
+
+class StubRailServer(ThreadingHTTPServer):
+    """HTTP server answering GetRoutes and voucher orders from the fixtures.
+
+    Attributes:
+        latency (number): seconds every response is delayed by.
+        jitter (number): random extra seconds (up to) added to the latency.
+        error_rate (float): the part of the requests answered with a 503 error.
+        routes (number): how many routes a GetRoutes response contains, the fixture routes are repeated or cut.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0, routes=None):
+        super().__init__(address, StubRailRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        with open(ROUTES_FIXTURE, encoding='utf8') as fixture:
+            self.routes_body = json.load(fixture)
+
+        with open(VOUCHER_FIXTURE, encoding='utf8') as fixture:
+            self.voucher_response = fixture.read().encode('utf8')
+
+        if routes is not None:
+            fixture_routes = self.routes_body['Data']['Routes']
+            self.routes_body['Data']['Routes'] = [fixture_routes[i % len(fixture_routes)] for i in range(routes)]
+
+        self._routes_responses = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}"
+
+    def routes_response(self, origin, destination, date):
+        """The fixture with the requested stations and date, rendered once per (origin, destination, date)."""
+        key = (origin, destination, date)
+        with self._lock:
+            self.requests += 1
+            if key not in self._routes_responses:
+                text = json.dumps(self.routes_body, ensure_ascii=False)
+                text = text.replace('05/10/2020', f'{date[6:8]}/{date[4:6]}/{date[0:4]}')
+                text = text.replace('"OrignStation": "3700"', f'"OrignStation": "{origin}"')
+                text = text.replace('"DestinationStation": "2100"', f'"DestinationStation": "{destination}"')
+                self._routes_responses[key] = text.encode('utf8')
+
+            return self._routes_responses[key]
+
+
+class StubRailRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real server
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != ROUTES_PATH:
+            return self._respond(404, b'{}')
+
+        query = parse_qs(url.query)
+        try:
+            body = self.server.routes_response(query['OId'][0], query['TId'][0], query['Date'][0])
+
+        except (KeyError, IndexError):
+            return self._respond(200, b'<html>bad request</html>')
+
+        self._respond(200, body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urlparse(self.path).path != VOUCHER_PATH:
+            return self._respond(404, b'{}')
+
+        with self.server._lock:
+            self.server.requests += 1
+
+        self._respond(200, self.server.voucher_response)
+
+    def _respond(self, status, body):
+        time.sleep(self.server.latency + random.uniform(0, self.server.jitter))
+        if random.random() < self.server.error_rate:
+            status, body = 503, b'Service Unavailable'
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server(host='127.0.0.1', port=0, **kwargs):
+    """Start a stub rail server on a background thread.
+
+    Returns:
+        StubRailServer. the running server, call `shutdown()` to stop it.
+    """
+    server = StubRailServer((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every response is delayed by')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='part of the requests answered with 503')
+    parser.add_argument('--routes', type=int, default=None, help='routes in every GetRoutes response')
+    args = parser.parse_args()
+
+    server = StubRailServer((args.host, args.port),
+                            latency=args.latency,
+                            jitter=args.jitter,
+                            error_rate=args.error_rate,
+                            routes=args.routes)
+    print(f"Stub rail server listening on {server.url}")
+    try:
+        server.serve_forever()
+
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ import os
 import re
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from typing import Dict
 from typing import List
@@ -24,11 +25,29 @@ from telegram.ext import ConversationHandler
 from telegram.ext import Filters
 from telegram.ext import MessageHandler
 from telegram.ext import Updater
-from telegram.ext.dispatcher import run_async
+from telegram.utils.promise import Promise
 
+import metrics
 import train_api
+from auto_order import AutoOrderScheduler
+from auto_order import parse_weekdays
+from auto_order import printable_weekdays
+from broadcast import Broadcaster
 from firebasepersistance import FirebasePersistence
+from prefetch import PairPopularity
+from prefetch import SpeculativePrefetcher
+from prefetch import TimetablePrefetcher
+from sqlitepersistance import SqlitePersistence
+from timetable_store import TimetableStore
+from train_api import Route
 from train_api import Train
+from users_registry import UsersRegistry
+from worker_pools import PoolSaturatedError
+from worker_pools import WorkerPools
+from worker_pools import in_worker_thread
+
+telegram_send_seconds = metrics.Histogram('telegram_send_seconds', 'Latency of the calls to the telegram bot API',
+                                          ('method',))
 
 
 def log_user(handler_function):
@@ -56,6 +75,41 @@ def handle_back(handle_state_function):
     return handler_wrapper
 
 
+def run_in_pool(pool_name):
+    """Run the handler on one of the bot's worker pools, like `run_async` but without sharing the dispatcher's workers.
+
+    A handler called from another pooled handler runs right away on the same worker. If the pool is saturated the user
+    is asked to try again and stays in the same state. Updates of the conversation arriving while the handler runs go
+    to the `ConversationHandler.WAITING` handlers.
+
+    Args:
+        pool_name (str): the name of the pool, one of `TrainCouponBot.RAIL_POOL`, `TELEGRAM_POOL` or `LOCAL_POOL`.
+    """
+    def decorator(handler_function):
+        @wraps(handler_function)
+        def wrapper(self, update, context, *args, **kwargs):
+            if in_worker_thread():
+                return handler_function(self, update, context, *args, **kwargs)
+
+            # the conversation handler waits on promises the same way it does for `run_async` handlers
+            promise = Promise(handler_function, (self, update, context) + args, kwargs)
+            try:
+                self.worker_pools[pool_name].submit(promise.run)
+
+            except PoolSaturatedError as e:
+                self.logger.warning(f'{handler_function.__name__} rejected: {e}')
+                with telegram_send_seconds.labels(method='sendMessage').time():
+                    context.bot.send_message(update.effective_chat.id, self.BOT_BUSY_MESSAGE)
+
+                return None
+
+            return promise
+
+        return wrapper
+
+    return decorator
+
+
 def move_to_main_on_error(handler_function):
     @wraps(handler_function)
     def wrapper(self, update, context, *args, **kwargs):
@@ -85,6 +139,9 @@ class States:
      SAVED_TRAINS,
      BROADCAST,
      DELETE_SAVED_TRAIN,
+     SCHEDULE_TRAIN,
+     SCHEDULE_DAYS,
+     SCHEDULE_LEAD,
      *_) = range(256)
 
 
@@ -110,27 +167,76 @@ class TrainCouponBot:
         logger_file_size (number): the size of each log file (only relevant if log_to_file is True).
         key (:obj:`str`, optional): Path to the SSL key file.
         cert (:obj:`str`, optional): Path to the SSL certificate file.
+        timetable_db (:obj:`str`, optional): Path to a local SQLite database the fetched trains are stored in, the
+            popular station pairs are then prefetched into it periodically.
+        prefetch_interval (number): seconds between prefetches of the popular station pairs (only relevant if
+            timetable_db is supplied).
+        prefetch_top_pairs (number): how many of the most popular station pairs are prefetched.
+        prefetch_days (number): how many days are prefetched for each pair, starting today.
+        speculative_destinations (number): how many of the most popular destinations of an origin station have today's
+            trains fetched while the user chooses the destination, 0 to disable.
+        speculative_max_in_flight (number): the maximum amount of days fetched at the same time for those
+            destinations.
+        metrics_port (:obj:`number`, optional): port to serve the metrics on in Prometheus text format, next to the
+            webhook / polling. the metrics are not served if it is not supplied.
+        auto_order_window (number): seconds before their lead time the scheduled orders of the saved trains are
+            spread over.
+        auto_order_concurrency (number): the maximum amount of scheduled orders running at the same time.
+        checkpoint_interval (number): seconds between the writes of the changed users state to firebase, the most
+            state lost if the bot crashes.
+        max_cached_users (number): the amount of users whose state is kept in memory, the others are fetched from
+            firebase when they use the bot.
+        persistence_db (:obj:`str`, optional): Path to a local SQLite database to keep the users state in instead of
+            firebase. the users registry, the broadcasts and the schedules are still kept in firebase.
+        broadcast_rate (number): the maximum amount of broadcast messages sent per second (telegram allows ~30).
+        broadcast_senders (number): the amount of broadcast messages sent concurrently.
+        registration_flush_interval (number): seconds between the writes of the newly registered users to firebase.
+        telegram_workers (number): the amount of handlers that only wait on telegram / firebase running at the same
+            time (the handlers waiting on the rail server are limited by num_threads).
+        local_workers (number): the amount of the other (quick) handlers running at the same time.
+        pool_queue_size (number): the amount of handlers waiting for a worker in each pool, the users are asked to try
+            again when it is full.
     """
     LOG_FILE = 'bot.log'
-    USERS_KEY = 'users'
 
     EDIT_ID = 'Edit ID'
     EDIT_EMAIL = 'Edit Email'
     ORDER_COUPON = 'Order voucher'
     SAVED_TRAINS = 'Saved trains'
     REMOVE_SAVED_TRAINS = 'Delete saved train'
+    SCHEDULE_TRAINS = 'Schedule saved train'
+
+    SUNDAY_TO_THURSDAY = 'Sun-Thu'
+    EVERY_DAY = 'Every day'
+    NO_SCHEDULE = 'Stop ordering automatically'
+    SCHEDULE_DAYS_OPTIONS = {SUNDAY_TO_THURSDAY: [6, 0, 1, 2, 3], EVERY_DAY: list(range(7))}
+    LEAD_MINUTES_OPTIONS = [['15', '30', '60'], ['120', '180']]
 
     BACK = 'Return to main menu'
 
     DONE_COMMAND = 'done'
 
+    RAIL_SERVER_BUSY_MESSAGE = 'The rail server is busy, please try again in a few minutes'
+    BOT_BUSY_MESSAGE = 'The bot is busy, please try again in a few seconds'
+    STILL_HANDLING_MESSAGE = 'Still working on your previous message, please wait a few seconds'
+
+    # handlers waiting on the rail server, handlers whose slow part is telegram / firebase, and all the others
+    RAIL_POOL = 'rail'
+    TELEGRAM_POOL = 'telegram'
+    LOCAL_POOL = 'local'
+
+    STATION_SUGGESTIONS = 6
+
+    PREFETCH_WORKERS = 4
+
     WELCOME_MESSAGE = "Welcome to Train Voucher bot,\n" \
                       "First, i need our details (Don't worry they are used only for the voucher)"
 
     MAIN_STATE_OPTIONS = [
         [EDIT_ID, EDIT_EMAIL],
         [ORDER_COUPON],
-        [SAVED_TRAINS, REMOVE_SAVED_TRAINS]
+        [SAVED_TRAINS, REMOVE_SAVED_TRAINS],
+        [SCHEDULE_TRAINS]
     ]
 
     def __init__(self,
@@ -147,6 +253,24 @@ class TrainCouponBot:
                  logger_file_size=2 ** 20,
                  key=None,
                  cert=None,
+                 timetable_db=None,
+                 prefetch_interval=30 * 60,
+                 prefetch_top_pairs=20,
+                 prefetch_days=3,
+                 speculative_destinations=3,
+                 speculative_max_in_flight=4,
+                 metrics_port=None,
+                 auto_order_window=30 * 60,
+                 auto_order_concurrency=4,
+                 checkpoint_interval=10,
+                 max_cached_users=10000,
+                 persistence_db=None,
+                 broadcast_rate=30,
+                 broadcast_senders=8,
+                 registration_flush_interval=5,
+                 telegram_workers=8,
+                 local_workers=4,
+                 pool_queue_size=100,
                  *args,
                  **kwargs):
         self.token = token
@@ -157,18 +281,49 @@ class TrainCouponBot:
         self.firebase_url = firebase_url
         self.key = key
         self.cert = cert
+        self.metrics_port = metrics_port
         if admins is None:
             admins = []
 
         self.admins = admins
         self.logger = self._configure_logger(logger_level, log_to_file, logger_file_amount, logger_file_size)
         self.firebase = firebase.FirebaseApplication(self.firebase_url)
+        self._rail_executor = ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix='rail')
+        # a slow rail server saturates only the rail pool, the other handlers keep their own workers
+        self.worker_pools = WorkerPools({self.RAIL_POOL: (self.num_threads, pool_queue_size),
+                                         self.TELEGRAM_POOL: (telegram_workers, pool_queue_size),
+                                         self.LOCAL_POOL: (local_workers, pool_queue_size)})
+        # Keep a pooled connection for every thread that may call the rail server at the same time: the rail handlers,
+        # the days they fetch, the prefetchers, the scheduled orders and the background refreshes of the routes cache.
+        prefetch_workers = self.PREFETCH_WORKERS if timetable_db is not None else 0
+        train_api.configure_client(pool_size=2 * self.num_threads + speculative_max_in_flight + prefetch_workers +
+                                   auto_order_concurrency + train_api.routes_cache.refresh_workers)
+        self.pair_popularity = PairPopularity()
+        self.speculative_prefetcher = SpeculativePrefetcher(self.pair_popularity,
+                                                            top_destinations=speculative_destinations,
+                                                            max_in_flight=speculative_max_in_flight)
+        if timetable_db is not None:
+            train_api.configure_timetable_store(TimetableStore(timetable_db))
 
         # Create the EventHandler and pass it your bot's token.
+        if persistence_db is not None:
+            self.persistence = SqlitePersistence(persistence_db, max_cached_users=max_cached_users)
+
+        else:
+            self.persistence = FirebasePersistence(firebase_url=self.firebase_url, max_cached_users=max_cached_users)
+
+        # the handlers run on the worker pools, the dispatcher's own async workers are not used. Keep a pooled
+        # telegram connection for every thread that may send at the same time: the pooled handlers, the broadcast
+        # senders, the scheduled orders, and the 4 threads of the updater itself (as PTB sizes it for its workers).
         self.updater = Updater(self.token,
-                               workers=self.num_threads,
-                               persistence=FirebasePersistence(firebase_url=self.firebase_url),
-                               use_context=True)
+                               workers=1,
+                               persistence=self.persistence,
+                               use_context=True,
+                               request_kwargs={'con_pool_size': self.num_threads + telegram_workers + local_workers +
+                                               broadcast_senders + auto_order_concurrency + 4})
+        self.updater.job_queue.run_repeating(self.persistence.checkpoint,
+                                             interval=checkpoint_interval,
+                                             first=checkpoint_interval)
 
         # Add conversation handler with the states GENDER, PHOTO, LOCATION and BIO
         conversation_handler = ConversationHandler(
@@ -182,9 +337,43 @@ class TrainCouponBot:
         )
 
         self.updater.dispatcher.add_handler(conversation_handler)
+        self._register_queue_metrics()
+
+        self.auto_order = AutoOrderScheduler(self.firebase,
+                                             self.updater.dispatcher,
+                                             spread_window=auto_order_window,
+                                             max_concurrency=auto_order_concurrency)
+        self.auto_order.start()
+
+        self.users_registry = UsersRegistry(self.firebase)
+        self.updater.job_queue.run_repeating(self.users_registry.flush,
+                                             interval=registration_flush_interval,
+                                             first=registration_flush_interval)
+        self.broadcaster = Broadcaster(self.updater.bot,
+                                       self.users_registry,
+                                       self.firebase,
+                                       rate=broadcast_rate,
+                                       senders=broadcast_senders)
+
+        if timetable_db is not None:
+            prefetcher = TimetablePrefetcher(self.pair_popularity,
+                                             top_pairs=prefetch_top_pairs,
+                                             days_ahead=prefetch_days,
+                                             max_workers=self.PREFETCH_WORKERS)
+            self.updater.job_queue.run_repeating(prefetcher.run, interval=prefetch_interval, first=prefetch_interval)
+
+    def _register_queue_metrics(self):
+        dispatcher = self.updater.dispatcher
+        metrics.CallbackMetric('dispatcher_update_queue_size', 'Updates waiting for the dispatcher',
+                               lambda: dispatcher.update_queue.qsize())
+        metrics.CallbackMetric('rail_executor_queue_size', 'Rail server calls waiting for a rail worker',
+                               lambda: self._rail_executor._work_queue.qsize())
 
     def run(self):
         """Start running the bot in polling / webhook mode."""
+        if self.metrics_port is not None:
+            metrics.start_metrics_server(int(self.metrics_port))
+
         if self.polling:
             self.updater.start_polling()
 
@@ -199,13 +388,20 @@ class TrainCouponBot:
                                        cert=self.cert,
                                        webhook_url=webhook_url)
 
+        # a broadcast interrupted by a restart continues from its last shard
+        self.broadcaster.resume()
+
         # Run the bot until you press Ctrl-C or the process receives SIGINT,
         # SIGTERM or SIGABRT. This should be used most of the time, since
         # start_polling() is non-blocking and will stop the bot gracefully.
         self.logger.info(f"Bot started running, polling={self.polling}, number of threads={self.num_threads}, "
-                         f"port={self.port}")
+                         f"port={self.port}, metrics port={self.metrics_port}")
         self.logger.info(f"current timezone is {datetime.datetime.now()}")
         self.updater.idle()
+        # the handlers still running, then their state and the users registered since the last flush
+        self.worker_pools.shutdown()
+        self.persistence.flush()
+        self.users_registry.flush()
 
     @property
     def states(self):
@@ -236,17 +432,18 @@ class TrainCouponBot:
                 [MessageHandler(Filters.text, self.handle_broadcast, pass_chat_data=True)],
             States.DELETE_SAVED_TRAIN:
                 [MessageHandler(Filters.text, self.handle_remove_saved_train, pass_chat_data=True)],
+            States.SCHEDULE_TRAIN:
+                [MessageHandler(Filters.text, self.handle_schedule_train, pass_chat_data=True)],
+            States.SCHEDULE_DAYS:
+                [MessageHandler(Filters.text, self.handle_schedule_days, pass_chat_data=True)],
+            States.SCHEDULE_LEAD:
+                [MessageHandler(Filters.text, self.handle_schedule_lead, pass_chat_data=True)],
+            # while a pooled handler of the conversation is still running
+            ConversationHandler.WAITING:
+                [MessageHandler(Filters.text, self.handle_waiting),
+                 CallbackQueryHandler(self.handle_waiting)],
         }
 
-    @property
-    def users(self) -> Dict:
-        """Dictionary of users.
-
-        Returns:
-            dict. dictionary of id to username (e.g. {'12345':"username"})
-        """
-        return self.firebase.get(f"/{self.USERS_KEY}", None)
-
     @property
     def _next_week(self) -> datetime.datetime:
         """Return a generator of the next 7 days from now on in datetime objects."""
@@ -257,12 +454,24 @@ class TrainCouponBot:
     @property
     def train_stations(self) -> List[str]:
         """return a list of hebrew names of the train stations available."""
-        return sorted([train_info['HE'] for train_info in train_api.stations_info.values()])
+        return train_api.station_names
 
     @property
     def _stations_keyboard(self):
         return [[i] for i in self.train_stations]
 
+    def _matching_stations_keyboard(self, station_text):
+        """Keyboard of the stations best matching a name the user typed, or of all the stations if none match.
+
+        Args:
+            station_text (str): partial or misspelled station name in any language (e.g. "haif").
+        """
+        station_ids = train_api.search_stations(station_text, limit=self.STATION_SUGGESTIONS)
+        if len(station_ids) == 0:
+            return self._stations_keyboard
+
+        return [[train_api.train_station_id_to_name(station_id)] for station_id in station_ids]
+
     @staticmethod
     def _id_valid(id_arg):
         return re.fullmatch(r'\d+', id_arg) is not None
@@ -271,9 +480,45 @@ class TrainCouponBot:
     def _email_valid(email):
         return re.fullmatch(r'.+@.+', email) is not None
 
+    def _trains_keyboard(self, context):
+        return [[i] for i in self._offered_routes(context).keys()]
+
     @staticmethod
-    def _trains_keyboard(context):
-        return [[i] for i in context.user_data['trains'].keys()]
+    def _offer_routes(context, origin_station_id, dest_station_id, date, routes):
+        """Keep the routes offered to the user as their day and train numbers, instead of the whole routes.
+
+        Args:
+            context (telegram.ext.callbackcontext.CallbackContext): current chat context.
+            origin_station_id (number): the origin station id.
+            dest_station_id (number): the destination station id.
+            date (datetime.date): the day of the routes.
+            routes (list): the offered routes of that day.
+        """
+        context.user_data['trains'] = {'day': [int(origin_station_id), int(dest_station_id), date.isoformat()],
+                                       'routes': [list(route.train_numbers) for route in routes]}
+
+    @staticmethod
+    def _offered_routes(context) -> Dict[str, Route]:
+        """The routes offered to the user by their printable travel time, resolved against the routes cache.
+
+        If the day is no longer cached it is loaded again.
+        """
+        trains = context.user_data['trains']
+        if 'day' not in trains:
+            # saved before the routes were kept by their train numbers, printable travel time to the route's dict, or
+            # to the train's dict before the routes had connecting trains
+            return {label: Route.from_json(route_dict) if 'Train' in route_dict else
+                    Route(trains=(Train.from_json(route_dict),))
+                    for label, route_dict in trains.items()}
+
+        origin_station_id, dest_station_id, date = trains['day']
+        # only the routes themselves are needed, ordering a train that is no longer available fails anyway
+        timetable = train_api.get_day_timetable(origin_station_id,
+                                                dest_station_id,
+                                                datetime.date.fromisoformat(date),
+                                                allow_stale=True)
+        routes = (timetable.route_by_train_numbers(train_numbers) for train_numbers in trains['routes'])
+        return {route.get_printable_travel_time(): route for route in routes if route is not None}
 
     @staticmethod
     def _saved_trains(context):
@@ -307,29 +552,12 @@ class TrainCouponBot:
     def _save_user(self, user):
         """Save a user's name and id to firebase DB for sending messages later.
 
-        Args:
-            user (telegram.user.User): the user to save to db.
-        """
-        self.firebase.patch(f'/{self.USERS_KEY}', {str(user.id): user.username})
-
-    def _broadcast_message_to_users(self, message):
-        """Send a message to all active users.
+        The user is buffered and written with the other new users on the next registry flush.
 
         Args:
-            message (str): message to send.
-
-        Note:
-            There is a delay between messages because telegram servers do not allow more than 20/30 messages per second.
+            user (telegram.user.User): the user to save to db.
         """
-        self.logger.info(f"Broadcasting message `{message}`")
-        for id, name in self.users.items():
-            time.sleep(.1)  # Telegram servers does not let you send more than 30 messages per second
-            try:
-                self.updater.bot.sendMessage(int(id), message)
-
-            except BaseException as e:
-                traceback.print_exc()
-                self.logger.info(f'Failed to broadcast message to {name} due to {e}')
+        self.users_registry.add(user.id, user.username)
 
     def _reformat_to_readable_date(self, d: datetime.datetime) -> str:
         """Convert datetime object into readable date label.
@@ -353,18 +581,17 @@ class TrainCouponBot:
         """
         if keyboard is not None:
             if not inline_keyboard:
-                update.message.reply_text(message,
-                                          reply_markup=ReplyKeyboardMarkup(
-                                              keyboard=[[self.BACK]] + keyboard,
-                                              one_time_keyboard=True))
+                reply_markup = ReplyKeyboardMarkup(keyboard=[[self.BACK]] + keyboard, one_time_keyboard=True)
 
             else:
                 kybd = [[InlineKeyboardButton(lb, callback_data=lb) for lb in lst] for lst in keyboard]
-                kybd = InlineKeyboardMarkup(inline_keyboard=kybd)
-                update.message.reply_text(message, reply_markup=kybd)
+                reply_markup = InlineKeyboardMarkup(inline_keyboard=kybd)
 
         else:
-            update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
+            reply_markup = ReplyKeyboardRemove()
+
+        with telegram_send_seconds.labels(method='sendMessage').time():
+            update.message.reply_text(message, reply_markup=reply_markup)
 
     def _reply_trains_list(self, update, context, date):
         """Send the list of trains to the user.
@@ -400,19 +627,21 @@ class TrainCouponBot:
                             keyboard=self.MAIN_STATE_OPTIONS,
                             inline_keyboard=True)
 
-    def _replay_coupon(self, update, context, current_train: Train, image_path):
+    def _replay_coupon(self, update, context, current_train: Train, qr_image):
         """Send the user train description and the QR image.
 
         Args:
             update (telegram.update.Update): current telegram update.
             context (telegram.ext.callbackcontext.CallbackContext): current chat context.
             current_train (train_api.Train): the train to order.
-            image_path (str): path to the qr image file.
+            qr_image (io.BytesIO): the qr image.
         """
         self._reply_message(update, str(current_train))
-        with open(image_path, 'rb') as qr_image:
+        with telegram_send_seconds.labels(method='sendChatAction').time():
             update.message.bot.send_chat_action(chat_id=update.effective_message.chat_id,
                                                 action=ChatAction.UPLOAD_PHOTO)
+
+        with telegram_send_seconds.labels(method='sendPhoto').time():
             update.message.reply_photo(qr_image)
 
         context.user_data['last_train'] = current_train.to_dict()
@@ -447,13 +676,37 @@ class TrainCouponBot:
             selected_train (Train): train instance to order seat to.
         """
         self._reply_message(update, message="Ordering coupon...")
-        image_path = f"{time.time_ns()}.jpeg"
-        train_api.request_train(user_id=context.user_data['id'],
-                                email=context.user_data['email'],
-                                train_instance=selected_train,
-                                image_dest=image_path)
-        self._replay_coupon(update, context, selected_train, image_path)
-        os.remove(image_path)
+        qr_image = train_api.request_train(user_id=context.user_data['id'],
+                                           email=context.user_data['email'],
+                                           train_instance=selected_train)
+        self._replay_coupon(update, context, selected_train, qr_image)
+
+    def _order_route(self, update, context, selected_route):
+        """Order a seat in every train of a route concurrently, reply back the QR images.
+
+        Args:
+            update (telegram.update.Update): current telegram update.
+            context (telegram.ext.callbackcontext.CallbackContext): current chat context.
+            selected_route (Route): route with connecting trains to order seats to.
+
+        Raises:
+            Exception: the first error that occurred while ordering, after the QR images that were ordered are sent.
+        """
+        self._reply_message(update, message=f"Ordering {len(selected_route.trains)} coupons...")
+        results = train_api.request_route(user_id=context.user_data['id'],
+                                          route=selected_route,
+                                          email=context.user_data['email'],
+                                          executor=self._rail_executor)
+        errors = []
+        for train, result in zip(selected_route.trains, results):
+            if isinstance(result, Exception):
+                errors.append(result)
+
+            else:
+                self._replay_coupon(update, context, train, result)
+
+        if len(errors) > 0:
+            raise errors[0]
 
     def _handle_train_order(self,
                             update,
@@ -469,6 +722,10 @@ class TrainCouponBot:
         try:
             self._order_train(update, context, selected_train)
 
+        except train_api.RailServerUnavailableError as e:
+            self.logger.warning(f'rail server unavailable in request_train {e}')
+            self._reply_message(update, self.RAIL_SERVER_BUSY_MESSAGE)
+
         except (AttributeError, ValueError, RuntimeError) as e:
             traceback.print_exc()
             self.logger.error(f'exception occurred in request_train {e}')
@@ -499,11 +756,11 @@ class TrainCouponBot:
         Returns:
             Train. return the train if found one the servers or None is no train found.
         """
-        available_trains = train_api.get_available_trains(selected_train.origin_station_id,
-                                                          selected_train.destination_station_id,
-                                                          date=request_train_datetime)
-        for train in available_trains:
-            if train.get_printable_travel_time() == selected_train.get_printable_travel_time():
+        timetable = train_api.get_day_timetable(selected_train.origin_station_id,
+                                                selected_train.destination_station_id,
+                                                date=request_train_datetime.date())
+        for train in timetable.trains_departing_at(request_train_datetime):
+            if train.arrival_time == selected_train.arrival_time:
                 return train
 
     def _handle_train_validation(self,
@@ -534,38 +791,60 @@ class TrainCouponBot:
 
             return train
 
+        except train_api.RailServerUnavailableError as e:
+            self.logger.warning(f'rail server unavailable in get_day_timetable {e}')
+            self._reply_message(update, self.RAIL_SERVER_BUSY_MESSAGE)
+            return self._move_to_main_state(update, context)
+
         except (AttributeError, ValueError) as e:
             traceback.print_exc()
             self.logger.error(f'exception occurred in get_available_trains {e}')
             self._reply_message(update, 'Error occurred please try again')
             return self._move_to_main_state(update, context)
 
-    def _get_next_available_train_list(self, context) -> Tuple[List, datetime.datetime]:
-        """Return the first day which has trains available.
+    def _get_next_available_route_list(self, context, allow_stale=False) -> Tuple[List, datetime.datetime]:
+        """Return the first day which has routes available.
 
-        Search the next week from now if there are trains available.
+        Search the next week from now if there are trains available, the days are fetched concurrently on the rail
+        executor, see `train_api.get_first_day_with_routes`.
 
         Args:
             context (telegram.ext.callbackcontext.CallbackContext): current chat context.
+            allow_stale (bool): Optional. whether expired cached days can be used while refreshed in the background.
 
         Returns:
-            tuple. the list of trains and the day that the trains are available.
+            tuple. the list of routes and the day that the routes are available.
 
         Raises:
+            RailServerUnavailableError: the rail server is not responding.
             RuntimeError: general error happened on the server.
         """
+        origin_station_id = context.user_data['origin_station_id']
+        dest_station_id = context.user_data['dest_station_id']
+
+        def log_fetched(day, routes, elapsed):
+            self.logger.info(f"Fetched routes {origin_station_id} -> {dest_station_id} for "
+                             f"{day.date()} in {elapsed:.3f}s")
+
+        start = time.perf_counter()
         try:
-            for day in self._next_week:
-                trains = list(train_api.get_available_trains(origin_station_id=context.user_data['origin_station_id'],
-                                                             dest_station_id=context.user_data['dest_station_id'],
-                                                             date=day))
-                if len(trains) > 0:
-                    return trains, day
+            found = train_api.get_first_day_with_routes(origin_station_id,
+                                                        dest_station_id,
+                                                        self._next_week,
+                                                        self._rail_executor,
+                                                        allow_stale=allow_stale,
+                                                        on_fetched=log_fetched)
 
         except (ValueError, AttributeError):
             traceback.print_exc()
             raise RuntimeError("general error")
 
+        if found is not None:
+            self.logger.info(f"Next week scan found routes on {found[1].date()} after "
+                             f"{time.perf_counter() - start:.3f}s")
+
+        return found
+
     # State handlers
     @move_to_main_on_error
     @log_user
@@ -578,11 +857,15 @@ class TrainCouponBot:
 
     @move_to_main_on_error
     @log_user
-    @run_async
+    @run_in_pool(TELEGRAM_POOL)
     def handle_broadcast(self, update, context):
         message_to_broadcast = update.message.text
-        self._broadcast_message_to_users(message_to_broadcast)
-        self._reply_message(update, "done")
+        self.logger.info(f"Broadcasting message `{message_to_broadcast}`")
+        if self.broadcaster.start(message_to_broadcast, update.effective_chat.id):
+            self._reply_message(update, "Broadcasting, the progress will be sent here")
+
+        else:
+            self._reply_message(update, "Another broadcast is running, please try again when it is done")
 
         if self._is_initiated(context):
             return self._move_to_main_state(update, context)
@@ -590,7 +873,7 @@ class TrainCouponBot:
         else:
             return self.handle_start(update, context)
 
-    @run_async
+    @run_in_pool(TELEGRAM_POOL)
     @log_user
     def handle_start(self, update, context):
         self._reply_message(update, self.WELCOME_MESSAGE)
@@ -598,6 +881,7 @@ class TrainCouponBot:
         self._reply_message(update, 'Please enter your ID')
         return States.ID
 
+    @run_in_pool(LOCAL_POOL)
     @log_user
     def handle_id(self, update, context):
         user_id = update.message.text.strip()
@@ -611,6 +895,7 @@ class TrainCouponBot:
         'cancellation link) or send /done.')
         return States.EMAIL
 
+    @run_in_pool(LOCAL_POOL)
     @log_user
     def handle_email(self, update, context):
         email = update.message.text.strip()
@@ -624,6 +909,7 @@ class TrainCouponBot:
         context.user_data['email'] = email
         return self._move_to_main_state(update, context)
 
+    @run_in_pool(LOCAL_POOL)
     @log_user
     def handle_main_state(self, update, context):
         """Main state callback.
@@ -634,6 +920,7 @@ class TrainCouponBot:
             * order coupon
             * saved trains
             * remove saved train
+            * schedule saved train
 
         Args:
             update (telegram.update.Update): current telegram update.
@@ -656,7 +943,8 @@ class TrainCouponBot:
         if option.data == self.ORDER_COUPON:
             option.edit_message_text(text=self.ORDER_COUPON)
             self._reply_message(option,
-                                message='Please choose an origin station from the list below',
+                                message='Please choose an origin station from the list below '
+                                        '(or type a part of its name)',
                                 keyboard=self._stations_keyboard)
             return States.HANDLE_ORIGIN_STATION
 
@@ -682,6 +970,23 @@ class TrainCouponBot:
                                 keyboard=self._saved_trains_keyboard(context))
             return States.DELETE_SAVED_TRAIN
 
+        if option.data == self.SCHEDULE_TRAINS:
+            option.edit_message_text(text=self.SCHEDULE_TRAINS)
+            if len(self._saved_trains(context)) == 0:
+                self._reply_message(option, 'No saved trains found, order first to save')
+                return self._move_to_main_state(option, context)
+
+            schedules = self.auto_order.schedules_of(option.from_user.id)
+            scheduled = ''.join(f"\n{label}: {printable_weekdays(schedule['weekdays'])}, "
+                                f"{schedule['lead_minutes']} minutes before"
+                                for label, schedule in schedules.items())
+            self._reply_message(option,
+                                message=f'Scheduled trains:{scheduled or " none"}\n'
+                                        f'Choose a train to order automatically from the list below',
+                                keyboard=self._saved_trains_keyboard(context))
+            return States.SCHEDULE_TRAIN
+
+    @run_in_pool(LOCAL_POOL)
     @move_to_main_on_error
     @log_user
     def handle_edit_id(self, update, context):
@@ -694,6 +999,7 @@ class TrainCouponBot:
         self._reply_message(update, f'Success! new ID is {user_id}')
         return self._move_to_main_state(update, context)
 
+    @run_in_pool(LOCAL_POOL)
     @move_to_main_on_error
     @log_user
     def handle_edit_email(self, update, context):
@@ -709,18 +1015,21 @@ class TrainCouponBot:
         self._reply_message(update, f'Success! new email address is {email if email != "" else "empty"}')
         return self._move_to_main_state(update, context)
 
+    @run_in_pool(LOCAL_POOL)
     @move_to_main_on_error
     @log_user
     @handle_back
     def handle_origin_station(self, update, context):
         origin_station = update.message.text
-        if origin_station not in self.train_stations:
+        if origin_station not in train_api.station_names_set:
             self._reply_message(update,
                                 message='Please choose a station from the list below',
-                                keyboard=self._stations_keyboard)
+                                keyboard=self._matching_stations_keyboard(origin_station))
             return States.HANDLE_ORIGIN_STATION
 
         context.user_data['origin_station_id'] = train_api.train_station_name_to_id(origin_station)
+        # warm today's trains of the likely destinations while the user picks one
+        self.speculative_prefetcher.origin_selected(context.user_data['origin_station_id'])
         self._reply_message(update,
                             f'Success! origin station picked is {origin_station}.\n'
                             f'Please choose a destination station from the list below',
@@ -728,53 +1037,78 @@ class TrainCouponBot:
         return States.HANDLE_DEST_STATION
 
     @log_user
-    @run_async
+    @run_in_pool(RAIL_POOL)
     @move_to_main_on_error
     @handle_back
     def handle_dest_station(self, update, context):
         destination_station = update.message.text
-        if destination_station not in self.train_stations:
+        if destination_station not in train_api.station_names_set:
             self._reply_message(update,
                                 message='Please choose a station from the list below',
-                                keyboard=self._stations_keyboard)
+                                keyboard=self._matching_stations_keyboard(destination_station))
             return States.HANDLE_DEST_STATION
 
         context.user_data['dest_station_id'] = train_api.train_station_name_to_id(destination_station)
+        self.pair_popularity.record(context.user_data['origin_station_id'], context.user_data['dest_station_id'])
+        self.speculative_prefetcher.destination_selected(context.user_data['origin_station_id'],
+                                                         context.user_data['dest_station_id'])
 
         try:
             self._reply_message(update, message="Retrieving trains...")
-            trains = self._get_next_available_train_list(context)
-            if trains is None:
+            # The rail server rejects orders of trains that are no longer available, an outdated list is good enough.
+            routes = self._get_next_available_route_list(context, allow_stale=True)
+            if routes is None:
                 self._reply_message(update, "No trains are available for the next week")
                 return self._move_to_main_state(update, context)
 
-            trains, day = trains
-            trains = {train.get_printable_travel_time(): train.to_dict() for train in trains}
-            context.user_data['trains'] = trains
+            routes, day = routes
+            self._offer_routes(context,
+                               context.user_data['origin_station_id'],
+                               context.user_data['dest_station_id'],
+                               day.date(),
+                               routes)
             self._reply_trains_list(update, context, date=day)
             return States.HANDLE_TRAIN
 
+        except train_api.RailServerUnavailableError as e:
+            self.logger.warning(f'rail server unavailable in handle_dest_station {e}')
+            self._reply_message(update, self.RAIL_SERVER_BUSY_MESSAGE)
+            return self._move_to_main_state(update, context)
+
         except RuntimeError:
             self._reply_message(update, 'An error occurred on the server, Please try again')
             return self._move_to_main_state(update, context)
 
     @log_user
-    @run_async
+    @run_in_pool(RAIL_POOL)
     @move_to_main_on_error
     @handle_back
     def handle_train(self, update, context):
         train_date = update.message.text
-        if train_date not in context.user_data['trains'].keys():
+        try:
+            # the offered day may have to be loaded again from the rail server
+            offered_routes = self._offered_routes(context)
+
+        except train_api.RailServerUnavailableError as e:
+            self.logger.warning(f'rail server unavailable in handle_train {e}')
+            self._reply_message(update, self.RAIL_SERVER_BUSY_MESSAGE)
+            return self._move_to_main_state(update, context)
+
+        if train_date not in offered_routes.keys():
             self._reply_message(update,
                                 message='Please select a train from the list below',
-                                keyboard=self._trains_keyboard(context))
+                                keyboard=[[i] for i in offered_routes.keys()])
             return States.HANDLE_TRAIN
 
-        current_train = context.user_data['trains'][train_date]
-        current_train: Train = Train.from_json(current_train)
+        route = offered_routes[train_date]
 
         try:
-            self._order_train(update, context, current_train)
+            if not route.is_direct:
+                self._order_route(update, context, route)
+                context.user_data['trains'] = {}
+                return self._move_to_main_state(update, context)
+
+            self._order_train(update, context, route.trains[0])
             self._reply_message(update,
                                 "Save this train for faster access?",
                                 keyboard=[['Yes', 'No']])
@@ -793,16 +1127,23 @@ class TrainCouponBot:
         except ValueError:
             traceback.print_exc()
             self._reply_message(update, 'An error occurred on the server, please try again')
-            self._reply_trains_list(update, context, date=current_train.departure_datetime)
+            self._reply_trains_list(update, context, date=route.departure_datetime)
             return States.HANDLE_TRAIN
 
 
+        except train_api.RailServerUnavailableError as e:
+            self.logger.warning(f'rail server unavailable in handle_train {e}')
+            self._reply_message(update, self.RAIL_SERVER_BUSY_MESSAGE)
+            self._reply_trains_list(update, context, date=route.departure_datetime)
+            return States.HANDLE_TRAIN
+
         except train_api.TrainSeatError as e:
             traceback.print_exc()
             self._reply_message(update, f"Error occurred: {e.message}")
-            self._reply_trains_list(update, context, date=current_train.departure_datetime)
+            self._reply_trains_list(update, context, date=route.departure_datetime)
             return States.HANDLE_TRAIN
 
+    @run_in_pool(LOCAL_POOL)
     @move_to_main_on_error
     @log_user
     @handle_back
@@ -820,7 +1161,7 @@ class TrainCouponBot:
 
         return self._move_to_main_state(update, context)
 
-    @run_async
+    @run_in_pool(RAIL_POOL)
     @move_to_main_on_error
     @handle_back
     @log_user
@@ -874,6 +1215,7 @@ class TrainCouponBot:
 
         return self._move_to_main_state(update, context)
 
+    @run_in_pool(LOCAL_POOL)
     @move_to_main_on_error
     @log_user
     @handle_back
@@ -896,9 +1238,128 @@ class TrainCouponBot:
             return States.DELETE_SAVED_TRAIN
 
         context.user_data['saved_trains'].pop(selected_train_label)
+        self.auto_order.remove_schedule(update.effective_user.id, selected_train_label)
         self._reply_message(update, "Success! train has been removed")
         return self._move_to_main_state(update, context)
 
+    @run_in_pool(LOCAL_POOL)
+    @move_to_main_on_error
+    @log_user
+    @handle_back
+    def handle_schedule_train(self, update, context):
+        """Schedule train state callback, choose the saved train to order automatically.
+
+        Args:
+            update (telegram.update.Update): current telegram update.
+            context (telegram.ext.callbackcontext.CallbackContext): current chat context.
+
+        Returns:
+            int. the new state to move to.
+        """
+        selected_train_label = update.message.text
+        if selected_train_label not in self._saved_trains(context).keys():
+            self._reply_message(update,
+                                "Please select a train from the list below",
+                                keyboard=self._saved_trains_keyboard(context))
+            return States.SCHEDULE_TRAIN
+
+        context.user_data['schedule_train'] = selected_train_label
+        self._reply_message(update,
+                            "On which days should the voucher be ordered? choose from the list below or type the "
+                            "days (e.g. Sun Tue Thu)",
+                            keyboard=[[self.SUNDAY_TO_THURSDAY, self.EVERY_DAY], [self.NO_SCHEDULE]])
+        return States.SCHEDULE_DAYS
+
+    @run_in_pool(LOCAL_POOL)
+    @move_to_main_on_error
+    @log_user
+    @handle_back
+    def handle_schedule_days(self, update, context):
+        """Schedule days state callback, choose the weekdays to order the saved train on.
+
+        Args:
+            update (telegram.update.Update): current telegram update.
+            context (telegram.ext.callbackcontext.CallbackContext): current chat context.
+
+        Returns:
+            int. the new state to move to.
+        """
+        option = update.message.text
+        if option == self.NO_SCHEDULE:
+            self.auto_order.remove_schedule(update.effective_user.id, context.user_data.pop('schedule_train'))
+            self._reply_message(update, "The train won't be ordered automatically anymore")
+            return self._move_to_main_state(update, context)
+
+        try:
+            weekdays = self.SCHEDULE_DAYS_OPTIONS.get(option) or parse_weekdays(option)
+
+        except ValueError:
+            self._reply_message(update,
+                                "Please choose from the list below or type the days (e.g. Sun Tue Thu)",
+                                keyboard=[[self.SUNDAY_TO_THURSDAY, self.EVERY_DAY], [self.NO_SCHEDULE]])
+            return States.SCHEDULE_DAYS
+
+        context.user_data['schedule_weekdays'] = weekdays
+        self._reply_message(update,
+                            "How many minutes before the departure should the voucher be ordered?",
+                            keyboard=self.LEAD_MINUTES_OPTIONS)
+        return States.SCHEDULE_LEAD
+
+    @run_in_pool(LOCAL_POOL)
+    @move_to_main_on_error
+    @log_user
+    @handle_back
+    def handle_schedule_lead(self, update, context):
+        """Schedule lead state callback, choose how long before the departure to order and save the schedule.
+
+        Args:
+            update (telegram.update.Update): current telegram update.
+            context (telegram.ext.callbackcontext.CallbackContext): current chat context.
+
+        Returns:
+            int. the new state to move to.
+        """
+        lead_minutes = update.message.text
+        if re.fullmatch(r'\d+', lead_minutes) is None or not 0 < int(lead_minutes) < 24 * 60:
+            self._reply_message(update,
+                                "Please enter the amount of minutes (e.g. 30)",
+                                keyboard=self.LEAD_MINUTES_OPTIONS)
+            return States.SCHEDULE_LEAD
+
+        train_label = context.user_data.pop('schedule_train')
+        weekdays = context.user_data.pop('schedule_weekdays')
+        self.auto_order.set_schedule(update.effective_user.id,
+                                     update.effective_chat.id,
+                                     train_label,
+                                     Train.from_json(self._saved_trains(context)[train_label]),
+                                     weekdays,
+                                     int(lead_minutes))
+        self._reply_message(update,
+                            f'Success! {train_label} will be ordered on {printable_weekdays(weekdays)}, '
+                            f'{lead_minutes} minutes before it departs')
+        return self._move_to_main_state(update, context)
+
+    @log_user
+    def handle_waiting(self, update, context):
+        """Waiting state callback, for updates arriving while the previous update of the user is still handled.
+
+        Args:
+            update (telegram.update.Update): current telegram update.
+            context (telegram.ext.callbackcontext.CallbackContext): current chat context.
+
+        Returns:
+            None. the conversation stays in the state the running handler moves it to.
+        """
+        if update.callback_query is not None:
+            update.callback_query.answer(self.STILL_HANDLING_MESSAGE)
+            return None
+
+        # without a keyboard, the keyboard of the running handler's reply stays
+        with telegram_send_seconds.labels(method='sendMessage').time():
+            update.message.reply_text(self.STILL_HANDLING_MESSAGE)
+
+        return None
+
     @log_user
     def cancel(self, update, context):
         """Stop command fallback callback.
@@ -0,0 +1,199 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import BadRequest
+from telegram.error import RetryAfter
+from telegram.error import TelegramError
+from telegram.error import Unauthorized
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+broadcast_messages = metrics.Counter('broadcast_messages', 'Broadcast messages by outcome', ('outcome',))
+
+
+class TokenBucket:
+    """Thread-safe token bucket, limiting how many calls are made per second across all the threads.
+
+    Attributes:
+        rate (number): tokens added per second.
+        capacity (number): Optional. the maximum amount of tokens, the size of a burst. by default `rate`.
+        clock (callable): Optional. monotonic clock returning seconds.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for a while (e.g. the server asked to retry later)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, self.clock() + seconds)
+            self._tokens = 0
+
+
+class Broadcaster:
+    """Send a message to all the active users, concurrently and within telegram's rate limit.
+
+    The broadcast runs on a thread of its own. Its progress (the last user of the last finished shard and the
+    counters) is kept in firebase under `/broadcast`, so a broadcast interrupted by a restart is resumed by
+    :meth:`resume`. The admin who started it gets a progress message every `progress_interval` seconds.
+
+    Users who blocked the bot or deleted their chat are marked inactive in the users registry and skipped from then on.
+
+    Attributes:
+        bot (telegram.Bot): the bot sending the messages.
+        registry (users_registry.UsersRegistry): the users to send to.
+        firebase (firebase.FirebaseApplication): the db the broadcast progress is kept in.
+        rate (number): Optional. the maximum amount of messages sent per second.
+        senders (number): Optional. the amount of messages sent concurrently.
+        progress_interval (number): Optional. seconds between the progress messages to the admin.
+    """
+    BROADCAST_KEY = 'broadcast'
+
+    def __init__(self, bot, registry, firebase, rate=30, senders=8, progress_interval=60):
+        self.bot = bot
+        self.registry = registry
+        self.firebase = firebase
+        self.bucket = TokenBucket(rate)
+        self.senders = senders
+        self.progress_interval = progress_interval
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, message, admin_chat_id):
+        """Start broadcasting a message in the background.
+
+        Returns:
+            bool. whether the broadcast started, False if another broadcast is running.
+        """
+        progress = {'message': message, 'admin_chat_id': admin_chat_id, 'cursor': '',
+                    'sent': 0, 'inactive': 0, 'failed': 0}
+        return self._start(progress, save=True)
+
+    def resume(self):
+        """Resume the broadcast that was interrupted (e.g. by a restart), if there is one.
+
+        Returns:
+            bool. whether a broadcast was resumed.
+        """
+        progress = self.firebase.get(f'/{self.BROADCAST_KEY}', None)
+        if progress is None:
+            return False
+
+        logger.info(f"Resuming broadcast after user {progress['cursor']!r}")
+        return self._start(progress, save=False)
+
+    def _start(self, progress, save):
+        with self._lock:
+            if self.running:
+                return False
+
+            if save:
+                self.firebase.put('/', self.BROADCAST_KEY, progress)
+
+            self._thread = threading.Thread(target=self._run, args=(progress,), name='broadcast', daemon=True)
+            self._thread.start()
+            return True
+
+    def _run(self, progress):
+        start = time.monotonic()
+        last_report = start
+        try:
+            with ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix='broadcast') as executor:
+                for shard in self.registry.iter_shards(after=progress['cursor'] or None):
+                    outcomes = executor.map(lambda user: self._send(user[0], progress['message']), shard)
+                    for outcome in outcomes:
+                        progress[outcome] += 1
+
+                    progress['cursor'] = shard[-1][0]
+                    self.firebase.patch(f'/{self.BROADCAST_KEY}', {key: progress[key]
+                                                                  for key in ('cursor', 'sent', 'inactive', 'failed')})
+                    if time.monotonic() - last_report >= self.progress_interval:
+                        last_report = time.monotonic()
+                        self._report(progress, 'Broadcast progress')
+
+            self.firebase.put('/', self.BROADCAST_KEY, None)
+
+        except Exception as e:
+            # the progress saved in firebase is kept, so the broadcast is resumed on the next start
+            logger.exception(f"Broadcast stopped after user {progress['cursor']!r}")
+            self._report(progress, f'Broadcast failed ({e}), it will be resumed on the next restart')
+            return
+
+        self._report(progress, f'Broadcast done in {time.monotonic() - start:.0f}s')
+
+    def _send(self, user_id, message):
+        """Send the message to a user, waiting as long as telegram asks to.
+
+        Returns:
+            str. the outcome: 'sent', 'inactive' or 'failed'.
+        """
+        while True:
+            self.bucket.acquire()
+            try:
+                self.bot.send_message(int(user_id), message)
+                outcome = 'sent'
+
+            except RetryAfter as e:
+                # flood control, every sender waits
+                self.bucket.pause(e.retry_after)
+                continue
+
+            except Unauthorized:
+                self.registry.mark_inactive(user_id)
+                outcome = 'inactive'
+
+            except BadRequest as e:
+                if 'chat not found' in e.message.lower():
+                    self.registry.mark_inactive(user_id)
+                    outcome = 'inactive'
+
+                else:
+                    logger.info(f'Failed to broadcast message to {user_id} due to {e}')
+                    outcome = 'failed'
+
+            except TelegramError as e:
+                logger.info(f'Failed to broadcast message to {user_id} due to {e}')
+                outcome = 'failed'
+
+            broadcast_messages.labels(outcome=outcome).inc()
+            return outcome
+
+    def _report(self, progress, title):
+        try:
+            self.bucket.acquire()
+            # the users who were already inactive are skipped by the registry and are not counted
+            self.bot.send_message(progress['admin_chat_id'],
+                                  f"{title}: {progress['sent']} sent, {progress['inactive']} users newly inactive "
+                                  f"(blocked the bot or deleted the chat), {progress['failed']} failed")
+
+        except TelegramError as e:
+            logger.warning(f'Failed to send the broadcast progress: {e}')
@@ -0,0 +1,203 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ('value', 'created')
+
+    def __init__(self, value, created):
+        self.value = value
+        self.created = created
+
+
+class TTLCache:
+    """Bounded thread-safe LRU cache where each value expires after a time to live.
+
+    Concurrent misses on the same key share a single call to the loader (single flight), the other callers wait for
+    its result instead of loading the value themselves.
+
+    Attributes:
+        max_size (number): the maximum amount of keys kept, the least recently used key is evicted first.
+        ttl (number): seconds a value is considered fresh.
+        stale_ttl (number): Optional. seconds after the value expired that it can still be served when the caller
+            allows stale values, while a refresh runs in the background.
+        refresh_workers (number): Optional. the amount of background refreshes running at the same time, the other
+            refreshes wait for a free worker.
+        clock (callable): Optional. monotonic clock returning seconds.
+    """
+
+    def __init__(self, max_size, ttl, stale_ttl=0, refresh_workers=4, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.refresh_workers = refresh_workers
+        self.clock = clock
+        # threads are started only on the first refresh
+        self._refresh_executor = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix='cache-refresh')
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'joined': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.peek(key) is not None
+
+    def peek(self, key):
+        """Return the fresh value of the key without loading it, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self.clock() - entry.created >= self.ttl:
+                return None
+
+            return entry.value
+
+    def get_or_load(self, key, loader, allow_stale=False, refresh_loader=None):
+        """Get the value of the key, loading it with `loader` if it is missing or expired.
+
+        Args:
+            key (hashable): the key of the value.
+            loader (callable): function without arguments that returns the value of the key.
+            allow_stale (bool): Optional. whether an expired value (up to `stale_ttl` seconds) can be returned
+                immediately, the value is then refreshed in the background.
+            refresh_loader (callable): Optional. function loading the value in the background refreshes, e.g. to skip
+                a slower copy `loader` reads first. by default `loader`.
+
+        Returns:
+            object. the value of the key.
+
+        Raises:
+            Exception: any exception raised by the loader, to every caller waiting on that load.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            age = None if entry is None else self.clock() - entry.created
+            if entry is not None and age < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry.value
+
+            if entry is not None and allow_stale and age < self.ttl + self.stale_ttl:
+                self.stats['stale_hits'] += 1
+                if key not in self._in_flight:
+                    future = self._in_flight[key] = Future()
+                    self._refresh_executor.submit(self._refresh, key, refresh_loader or loader, future)
+
+                return entry.value
+
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._in_flight[key] = Future()
+                self.stats['misses'] += 1
+
+            else:
+                self.stats['joined'] += 1
+
+        if not is_leader:
+            return future.result()
+
+        return self._load(key, loader, future)
+
+    def put(self, key, value):
+        with self._lock:
+            self._set(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _load(self, key, loader, future):
+        try:
+            value = loader()
+
+        except BaseException as e:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._set(key, value)
+            self._in_flight.pop(key, None)
+
+        future.set_result(value)
+        return value
+
+    def _refresh(self, key, loader, future):
+        try:
+            self._load(key, loader, future)
+
+        except Exception:
+            logger.exception(f"Background refresh of {key} failed")
+
+    def _set(self, key, value):
+        self._entries[key] = _Entry(value, self.clock())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share a single call of the function, the other callers wait for its result.
+
+    Unlike :class:`TTLCache` nothing is kept after the call returns, the next call with the key calls the function
+    again.
+
+    Attributes:
+        stats (dict): the amount of `calls` made and of calls `joined` to a running call instead.
+    """
+
+    def __init__(self):
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'joined': 0}
+
+    def do(self, key, function):
+        """Return the result of `function`, or of the running call with the same key.
+
+        Raises:
+            Exception: any exception raised by the function, to every caller waiting on that call.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._in_flight[key] = Future()
+                self.stats['calls'] += 1
+
+            else:
+                self.stats['joined'] += 1
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            value = function()
+
+        except BaseException as e:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._in_flight.pop(key, None)
+
+        future.set_result(value)
+        return value
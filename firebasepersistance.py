@@ -1,93 +1,74 @@
-import copy
-import json
-from collections import defaultdict
-
-from cached_property import cached_property
 from firebase import firebase
-from telegram.ext import BasePersistence
-from telegram.utils.helpers import decode_user_chat_data_from_json
-from telegram.utils.promise import Promise
 
-from utils import decode_conversations
-from utils import enocde_conversations
+from persistence import IncrementalPersistence
+from utils import decode_conversation_key
+from utils import encode_conversation_key
+from utils import encode_legacy_conversation_key
+from utils import is_legacy_conversation_key
 
 
 # TODO add authentication
-class FirebasePersistence(BasePersistence):
+class FirebasePersistence(IncrementalPersistence):
+    """Persist the bot's user data, chat data and conversations in a firebase db.
+
+    Every user and chat is fetched on its own path when it is first used, and the changed keys are written in a
+    single multi-path PATCH, see :class:`persistence.IncrementalPersistence`.
+
+    Attributes:
+        firebase_url (str): url of the firebase db.
+        max_cached_users (number): Optional. the amount of users (and of chats) whose data is kept in memory.
+    """
+    BACKEND = 'firebase'
+
     USER_DATA_KEY = 'user_data'
     CHAT_DATA_KEY = 'chat_data'
     CONVERSATION_KEY = 'conversations'
 
-    def __init__(self, firebase_url):
-        super().__init__()
+    def __init__(self, firebase_url, max_cached_users=10000):
         self.firebase = firebase.FirebaseApplication(firebase_url)
+        # (name, key) of the conversations stored with the legacy key format, moved to the new format on their next
+        # write
+        self._legacy_conversation_keys = set()
+        super().__init__(max_cached_users)
 
-    @cached_property
-    def user_data(self):
-        user_data = self.firebase.get(f'/{self.USER_DATA_KEY}', None)
-        if user_data is None:
-            user_data = {}
-
-        user_data = decode_user_chat_data_from_json(json.dumps(user_data))
-        return defaultdict(dict, user_data)
+    def _fetch_user_data(self, user_id):
+        return self.firebase.get(f'/{self.USER_DATA_KEY}', str(user_id))
 
-    @cached_property
-    def chat_data(self):
-        chat_data = self.firebase.get(f'/{self.CHAT_DATA_KEY}', None)
-        if chat_data is None:
-            chat_data = {}
+    def _fetch_chat_data(self, chat_id):
+        return self.firebase.get(f'/{self.CHAT_DATA_KEY}', str(chat_id))
 
-        chat_data = decode_user_chat_data_from_json(json.dumps(chat_data))
-        return defaultdict(dict, chat_data)
-
-    @cached_property
-    def conversations(self):
+    def _fetch_conversations(self):
         conversation = self.firebase.get(f'/{self.CONVERSATION_KEY}', None)
         if conversation is None:
             conversation = {}
 
-        return decode_conversations(conversation)
-
-    def _save_user_data(self):
-        self.firebase.put('/', self.USER_DATA_KEY, self.user_data)
-
-    def _save_chat_data(self):
-        self.firebase.put('/', self.CHAT_DATA_KEY, self.chat_data)
-
-    def _save_conversations(self):
-        # need the helper function because the keys are tuples and cannot be encoded to json
-        json_conversations = enocde_conversations(self.conversations)
-        self.firebase.put('/', self.CONVERSATION_KEY, json_conversations)
-
-    def get_chat_data(self):
-        return copy.deepcopy(self.chat_data)
-
-    def get_user_data(self):
-        return copy.deepcopy(self.user_data)
-
-    def get_conversations(self, name):
-        return copy.deepcopy(self.conversations.get(name, {}))
-
-    def update_conversation(self, name, key, new_state):
-        if name not in self.conversations:
-            self.conversations[name] = {}
-
-        # need this patch in case the result is running async (promise) since there is no support for this from
-        # python-telegram-bot
-        if isinstance(new_state, tuple):
-            old_state, new_state = new_state
-            if isinstance(new_state, Promise):
-                new_state = new_state.result()
-
-        self.conversations[name][key] = new_state
-
-    def update_user_data(self, user_id, data):
-        self.user_data[user_id] = data
-
-    def update_chat_data(self, chat_id, data):
-        self.chat_data[chat_id] = data
-
-    def flush(self):
-        self._save_chat_data()
-        self._save_user_data()
-        self._save_conversations()
+        conversations = {}
+        for name, states in conversation.items():
+            conversations[name] = {}
+            for encoded_key, state in states.items():
+                key = decode_conversation_key(encoded_key)
+                conversations[name][key] = state
+                if is_legacy_conversation_key(encoded_key):
+                    self._legacy_conversation_keys.add((name, key))
+
+        return conversations
+
+    def _write(self, user_data, chat_data, conversations):
+        # a multi-path update, path to new value (None deletes the path)
+        changes = {}
+        for user_id, data in user_data.items():
+            changes[f'{self.USER_DATA_KEY}/{user_id}'] = data
+
+        for chat_id, data in chat_data.items():
+            changes[f'{self.CHAT_DATA_KEY}/{chat_id}'] = data
+
+        for (name, key), state in conversations.items():
+            # need the helper function because the keys are tuples and cannot be encoded to json
+            changes[f'{self.CONVERSATION_KEY}/{name}/{encode_conversation_key(key)}'] = state
+            if (name, key) in self._legacy_conversation_keys:
+                legacy_key = encode_legacy_conversation_key(key)
+                if legacy_key != encode_conversation_key(key):
+                    changes[f'{self.CONVERSATION_KEY}/{name}/{legacy_key}'] = None
+
+        self.firebase.patch('/', changes)
+        self._legacy_conversation_keys.difference_update(conversations)
@@ -0,0 +1,256 @@
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class _ShardOwner:
+    """Kept only by the thread local of a thread, so it is collected (and its shard retired) when the thread ends."""
+    __slots__ = ('__weakref__',)
+
+
+class _ShardedMetric:
+    """Base of the metrics updated without locks.
+
+    Every thread writes only to its own shard, the shards are summed when the metric is collected, so the hot path is
+    a thread local lookup and an addition. The shard of a thread that ended is added to a retired total and dropped.
+    """
+
+    def __init__(self, labels=()):
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards = {}
+        self._retired = self._new_shard()
+        self._shards_lock = threading.Lock()
+
+    def _new_shard(self):
+        raise NotImplementedError
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._new_shard()
+            owner = self._local.owner = _ShardOwner()
+            weakref.finalize(owner, self._retire, shard)
+            with self._shards_lock:
+                self._shards[id(shard)] = shard
+
+            self._local.shard = shard
+
+        return shard
+
+    def _retire(self, shard):
+        with self._shards_lock:
+            for index, value in enumerate(shard):
+                self._retired[index] += value
+
+            del self._shards[id(shard)]
+
+    def _collected_shards(self):
+        # copied under the lock, so a shard retired meanwhile is not counted twice
+        with self._shards_lock:
+            return [list(shard) for shard in self._shards.values()] + [list(self._retired)]
+
+
+class _CounterChild(_ShardedMetric):
+    def _new_shard(self):
+        return [0]
+
+    def inc(self, amount=1):
+        self._shard()[0] += amount
+
+    @property
+    def value(self):
+        return sum(shard[0] for shard in self._collected_shards())
+
+    def samples(self, name):
+        yield f'{name}_total{_format_labels(self.labels)} {self.value}'
+
+
+class _HistogramChild(_ShardedMetric):
+    def __init__(self, buckets, labels=()):
+        self.buckets = buckets
+        super().__init__(labels)
+
+    def _new_shard(self):
+        # a counter per bucket, then the +Inf bucket, then the sum of the observed values
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value):
+        shard = self._shard()
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self, name):
+        totals = [0] * (len(self.buckets) + 2)
+        for shard in self._collected_shards():
+            for index, value in enumerate(shard):
+                totals[index] += value
+
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), totals):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield f'{name}_bucket{_format_labels(self.labels + (("le", le),))} {cumulative}'
+
+        yield f'{name}_sum{_format_labels(self.labels)} {totals[-1]}'
+        yield f'{name}_count{_format_labels(self.labels)} {cumulative}'
+
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, label_names=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._children_lock = threading.Lock()
+        (REGISTRY if registry is None else registry).register(self)
+
+    def _new_child(self, labels):
+        raise NotImplementedError
+
+    def labels(self, **label_values):
+        key = tuple(str(label_values[name]) for name in self.label_names)
+        child = self._children.get(key)
+        if child is None:
+            with self._children_lock:
+                child = self._children.setdefault(key, self._new_child(tuple(zip(self.label_names, key))))
+
+        return child
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.TYPE}'
+        for child in list(self._children.values()):
+            yield from child.samples(self.name)
+
+
+class Counter(_Metric):
+    """Monotonic counter, use `inc` directly or on `labels(...)` if the counter has label names."""
+    TYPE = 'counter'
+
+    def _new_child(self, labels):
+        return _CounterChild(labels)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Histogram(_Metric):
+    """Histogram of observed values (e.g. latencies in seconds) over fixed buckets."""
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, label_names, registry)
+
+    def _new_child(self, labels):
+        return _HistogramChild(self.buckets, labels)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class CallbackMetric:
+    """Metric read from a function when collected, for values already kept elsewhere (queue sizes, stats dicts).
+
+    The function returns either a number, or a dict of label values tuple to number.
+    """
+
+    def __init__(self, name, documentation, function, metric_type='gauge', label_names=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.metric_type = metric_type
+        self.label_names = tuple(label_names)
+        (REGISTRY if registry is None else registry).register(self)
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.metric_type}'
+        values = self.function()
+        if not isinstance(values, dict):
+            values = {(): values}
+
+        for label_values, value in values.items():
+            yield f'{self.name}{_format_labels(tuple(zip(self.label_names, label_values)))} {value}'
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        """Render all the metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            try:
+                lines.extend(metric.collect())
+
+            except Exception as e:
+                lines.append(f'# {metric.name} failed to collect: {e}')
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host='0.0.0.0', registry=REGISTRY):
+    """Serve the metrics on http://host:port/ in Prometheus text format from a background thread.
+
+    Returns:
+        http.server.ThreadingHTTPServer. the running server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
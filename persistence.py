@@ -0,0 +1,394 @@
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+from collections import defaultdict
+from collections.abc import MutableMapping
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.ext import BasePersistence
+from telegram.utils.promise import Promise
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+persistence_flush_seconds = metrics.Histogram('persistence_flush_seconds', 'Duration of the persistence flush',
+                                              ('backend',))
+persistence_flushed_keys = metrics.Counter('persistence_flushed_keys', 'User, chat and conversation keys written',
+                                           ('backend', 'kind'))
+
+
+class LazyDict(defaultdict):
+    """Dict of user / chat id to its data, where each id's data is fetched the first time it is used.
+
+    Up to `max_size` ids are kept in memory, beyond it :meth:`evict` drops the least recently used ids (they are
+    fetched again if they are used again) once their data is the same as what was last written and they were not used
+    for `idle_seconds`, so no handler still holds their data. Reads never drop ids, so the dict can be iterated and
+    indexed at the same time (as the dispatcher does on shutdown). Only the ids in memory are iterated, a snapshot of
+    them, so this is meant for the lookups the dispatcher does by id.
+
+    The handlers change the data of an id in place, so a copy of what was last written (or fetched) is kept for every
+    id in memory, and :meth:`changed` compares the data to it.
+
+    Attributes:
+        fetch (callable): returns the stored data of an id, or None if it has none.
+        max_size (number): the amount of ids kept in memory before dropping the clean least recently used ones.
+        is_dirty (callable): returns whether an id has changes that were not written yet, such ids are never dropped.
+        idle_seconds (number): Optional. seconds an id must not be used before it can be dropped.
+        clock (callable): Optional. monotonic clock returning seconds.
+    """
+    _MISSING = object()
+
+    def __init__(self, fetch, max_size, is_dirty, idle_seconds=0, clock=time.monotonic):
+        super().__init__(dict)
+        self.fetch = fetch
+        self.max_size = max_size
+        self.is_dirty = is_dirty
+        self.idle_seconds = idle_seconds
+        self.clock = clock
+        # id to the time it was last used, least recently used first
+        self._recent = OrderedDict()
+        self._written = {}
+        self._lock = threading.Lock()
+        self.stats = {'loads': 0, 'evictions': 0}
+
+    def __missing__(self, key):
+        value = self.fetch(key)
+        self.stats['loads'] += 1
+        # another thread may have loaded (or updated) the key meanwhile
+        value = self.setdefault(key, {} if value is None else value)
+        with self._lock:
+            if key not in self._written:
+                self._written[key] = copy.deepcopy(value)
+
+        self._touch(key)
+        return value
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self._touch(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._touch(key)
+
+    def __iter__(self):
+        # ids loaded by other threads meanwhile are not iterated
+        return iter(list(super().__iter__()))
+
+    def changed(self, key):
+        """Whether the data of the id differs from what was last written."""
+        return self.get(key) != self._written.get(key, self._MISSING)
+
+    def mark_written(self, key, data):
+        """Record the data written for the id, a copy that is not changed afterwards."""
+        with self._lock:
+            if key in self:
+                self._written[key] = data
+
+    def recently_used(self, seconds):
+        """Return the ids used in the last `seconds` seconds."""
+        with self._lock:
+            now = self.clock()
+            keys = []
+            for key, used in reversed(self._recent.items()):
+                if now - used > seconds:
+                    break
+
+                keys.append(key)
+
+            return keys
+
+    def evict(self):
+        """Drop the least recently used ids beyond `max_size` whose data was written and that are idle."""
+        with self._lock:
+            now = self.clock()
+            excess = len(self._recent) - self.max_size
+            if excess <= 0:
+                return
+
+            for old_key, used in list(islice(self._recent.items(), excess)):
+                if now - used <= self.idle_seconds:
+                    # the others were used even more recently
+                    break
+
+                if self.is_dirty(old_key) or self.changed(old_key):
+                    continue
+
+                del self._recent[old_key]
+                del self._written[old_key]
+                self.pop(old_key, None)
+                self.stats['evictions'] += 1
+
+    def _touch(self, key):
+        with self._lock:
+            self._recent[key] = self.clock()
+            self._recent.move_to_end(key)
+
+
+class CopyOnWriteDict(MutableMapping):
+    """Isolated view of a dict that copies a value only the first time it is read or written.
+
+    Changes to the view are kept aside and never reach the base dict, so handing out a view costs nothing up front
+    instead of a deep copy of the whole dict.
+
+    Attributes:
+        base (dict): the dict the view reads through to.
+    """
+    _DELETED = object()
+    _MISSING = object()
+
+    def __init__(self, base):
+        self.base = base
+        self._changes = {}
+
+    def __getitem__(self, key):
+        value = self._changes.get(key, self._MISSING)
+        if value is self._MISSING:
+            value = self._changes[key] = copy.deepcopy(self.base[key])
+
+        if value is self._DELETED:
+            raise KeyError(key)
+
+        return value
+
+    def __setitem__(self, key, value):
+        self._changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        self._changes[key] = self._DELETED
+
+    def __contains__(self, key):
+        value = self._changes.get(key, self._MISSING)
+        if value is self._MISSING:
+            return key in self.base
+
+        return value is not self._DELETED
+
+    def __iter__(self):
+        for key in self.base:
+            if key not in self._changes:
+                yield key
+
+        for key, value in self._changes.items():
+            if value is not self._DELETED:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class IncrementalPersistence(BasePersistence):
+    """Base of the persistences that load users lazily and write only the keys that changed.
+
+    The data of a user or chat is fetched the first time it is used, and only `max_cached_users` of them are kept in
+    memory, so startup does not depend on the amount of users. The conversations are fetched in the background as
+    soon as the persistence is created.
+
+    Only the keys that changed since the last flush are written, all of them in a single batch. Call
+    :meth:`checkpoint` periodically (e.g. from the JobQueue) so a crash loses only the changes since the last one.
+
+    The dispatcher persists an update right after its handler returns, before a handler running async changed
+    anything, and the handlers change the users data in place. So besides the updated keys, every checkpoint compares
+    the data of the users and chats used in the last `active_window` seconds to what was last written.
+
+    Subclasses implement the storage: `_fetch_user_data`, `_fetch_chat_data`, `_fetch_conversations` and `_write`.
+
+    Attributes:
+        max_cached_users (number): Optional. the amount of users (and of chats) whose data is kept in memory, more are
+            kept while they are in use or have changes that were not written.
+        active_window (number): Optional. seconds after its last use that a user's (or chat's) data is still checked
+            for changes, longer than a handler can run.
+    """
+    BACKEND = None
+
+    def __init__(self, max_cached_users=10000, active_window=300):
+        super().__init__()
+        self.active_window = active_window
+        self._dirty_user_ids = set()
+        self._dirty_chat_ids = set()
+        self._dirty_conversation_keys = set()
+        # keys being written by the running checkpoint, they must not be dropped from memory until it is done
+        self._flushing_user_ids = set()
+        self._flushing_chat_ids = set()
+        # conversation key to (old state, promise) of the handlers still running async
+        self._pending_states = {}
+        self._dirty_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.user_data = LazyDict(self._fetch_user_data, max_cached_users,
+                                  lambda user_id: user_id in self._dirty_user_ids or
+                                  user_id in self._flushing_user_ids,
+                                  idle_seconds=active_window)
+        self.chat_data = LazyDict(self._fetch_chat_data, max_cached_users,
+                                  lambda chat_id: chat_id in self._dirty_chat_ids or
+                                  chat_id in self._flushing_chat_ids,
+                                  idle_seconds=active_window)
+        loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='persistence')
+        self._conversations_future = loader.submit(self._fetch_conversations)
+        loader.shutdown(wait=False)
+
+    def _fetch_user_data(self, user_id):
+        """Return the stored data of the user, or None."""
+        raise NotImplementedError
+
+    def _fetch_chat_data(self, chat_id):
+        """Return the stored data of the chat, or None."""
+        raise NotImplementedError
+
+    def _fetch_conversations(self):
+        """Return all the stored conversations, a dict of name to dict of key (tuple) to state."""
+        raise NotImplementedError
+
+    def _write(self, user_data, chat_data, conversations):
+        """Write the changes in a single batch.
+
+        Args:
+            user_data (dict): user id to its new data, None to delete it.
+            chat_data (dict): chat id to its new data, None to delete it.
+            conversations (dict): (name, key) to the new state of the conversation.
+        """
+        raise NotImplementedError
+
+    @property
+    def conversations(self):
+        return self._conversations_future.result()
+
+    def get_chat_data(self):
+        # the dispatcher shares the lazy dict, so every chat is fetched only once
+        return self.chat_data
+
+    def get_user_data(self):
+        # the dispatcher shares the lazy dict, so every user is fetched only once
+        return self.user_data
+
+    def get_conversations(self, name):
+        return CopyOnWriteDict(self.conversations.setdefault(name, {}))
+
+    def update_conversation(self, name, key, new_state):
+        if name not in self.conversations:
+            self.conversations[name] = {}
+
+        # need this patch in case the result is running async (promise) since there is no support for this from
+        # python-telegram-bot
+        if isinstance(new_state, tuple):
+            old_state, promise = new_state
+            if isinstance(promise, Promise) and not promise.done.is_set():
+                # the dispatcher must not wait for the handler, its state is written by the checkpoint after it is done
+                with self._dirty_lock:
+                    self._pending_states[(name, key)] = (old_state, promise)
+
+                return
+
+            new_state = self._promise_state(old_state, promise)
+
+        self.conversations[name][key] = new_state
+        with self._dirty_lock:
+            self._pending_states.pop((name, key), None)
+            self._dirty_conversation_keys.add((name, key))
+
+    @staticmethod
+    def _promise_state(old_state, promise):
+        # the same as the conversation handler, a handler returning None (or failing) keeps the old state
+        try:
+            new_state = promise.result()
+
+        except Exception:
+            logger.exception('Conversation handler failed, keeping its previous state')
+            return old_state
+
+        return old_state if new_state is None else new_state
+
+    def _resolve_pending_states(self):
+        with self._dirty_lock:
+            done = [(name, key) for (name, key), (_, promise) in self._pending_states.items() if promise.done.is_set()]
+            for name, key in done:
+                old_state, promise = self._pending_states.pop((name, key))
+                self.conversations[name][key] = self._promise_state(old_state, promise)
+                self._dirty_conversation_keys.add((name, key))
+
+    def update_user_data(self, user_id, data):
+        self.user_data[user_id] = data
+        with self._dirty_lock:
+            self._dirty_user_ids.add(user_id)
+
+    def update_chat_data(self, chat_id, data):
+        self.chat_data[chat_id] = data
+        with self._dirty_lock:
+            self._dirty_chat_ids.add(chat_id)
+
+    def checkpoint(self, context=None):
+        """Write the keys that changed since the last checkpoint, can be used as a JobQueue callback.
+
+        If the write fails the keys are kept dirty and written on the next checkpoint.
+        """
+        with self._flush_lock:
+            # only ids written by the previous checkpoints can be dropped
+            self.user_data.evict()
+            self.chat_data.evict()
+            self._resolve_pending_states()
+            with self._dirty_lock:
+                user_ids, self._dirty_user_ids = self._dirty_user_ids, set()
+                chat_ids, self._dirty_chat_ids = self._dirty_chat_ids, set()
+                conversation_keys, self._dirty_conversation_keys = self._dirty_conversation_keys, set()
+                # not dropped from memory until their changes are known
+                self._flushing_user_ids, self._flushing_chat_ids = user_ids, chat_ids
+
+            user_data = self._changes(self.user_data, user_ids)
+            chat_data = self._changes(self.chat_data, chat_ids)
+            with self._dirty_lock:
+                self._flushing_user_ids, self._flushing_chat_ids = set(user_data), set(chat_data)
+
+            if len(user_data) + len(chat_data) + len(conversation_keys) == 0:
+                with self._dirty_lock:
+                    self._flushing_user_ids, self._flushing_chat_ids = set(), set()
+
+                return
+
+            try:
+                with persistence_flush_seconds.labels(backend=self.BACKEND).time():
+                    self._write(user_data,
+                                chat_data,
+                                {(name, key): self.conversations.get(name, {}).get(key)
+                                 for name, key in conversation_keys})
+
+            except Exception:
+                logger.exception('Persistence checkpoint failed, retrying on the next one')
+                with self._dirty_lock:
+                    self._dirty_user_ids |= user_data.keys()
+                    self._dirty_chat_ids |= chat_data.keys()
+                    self._dirty_conversation_keys |= conversation_keys
+
+                return
+
+            finally:
+                with self._dirty_lock:
+                    self._flushing_user_ids, self._flushing_chat_ids = set(), set()
+
+            for user_id, data in user_data.items():
+                self.user_data.mark_written(user_id, data)
+
+            for chat_id, data in chat_data.items():
+                self.chat_data.mark_written(chat_id, data)
+
+            persistence_flushed_keys.labels(backend=self.BACKEND, kind='user_data').inc(len(user_data))
+            persistence_flushed_keys.labels(backend=self.BACKEND, kind='chat_data').inc(len(chat_data))
+            persistence_flushed_keys.labels(backend=self.BACKEND, kind='conversations').inc(len(conversation_keys))
+
+    def _changes(self, lazy_dict, updated_ids):
+        """Return a copy of the data of the updated and the recently used ids that changed since it was written."""
+        changes = {}
+        for key in updated_ids.union(lazy_dict.recently_used(self.active_window)):
+            if key in lazy_dict and lazy_dict.changed(key):
+                changes[key] = copy.deepcopy(lazy_dict.get(key))
+
+        return changes
+
+    def flush(self):
+        self.checkpoint()
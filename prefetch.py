@@ -0,0 +1,168 @@
+import datetime
+import heapq
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import train_api
+
+logger = logging.getLogger(__name__)
+
+
+class PairPopularity:
+    """Thread-safe counts of the (origin, destination) pairs users looked up."""
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, origin_station_id, dest_station_id):
+        with self._lock:
+            self._counts[(int(origin_station_id), int(dest_station_id))] += 1
+
+    def top(self, amount):
+        """Return the `amount` most looked up pairs, most popular first."""
+        with self._lock:
+            return [pair for pair, _ in self._counts.most_common(amount)]
+
+    def top_destinations(self, origin_station_id, amount):
+        """Return the `amount` destinations most looked up from the origin, most popular first."""
+        origin_station_id = int(origin_station_id)
+        with self._lock:
+            counts = [(count, dest) for (origin, dest), count in self._counts.items() if origin == origin_station_id]
+
+        return [dest for _, dest in heapq.nlargest(amount, counts)]
+
+
+class TimetablePrefetcher:
+    """Fetch the next days of the most popular station pairs ahead of time.
+
+    Meant to run periodically from the dispatcher's JobQueue, every run refreshes the days in the routes cache and in
+    the local timetable store, so the trains list is served without waiting for the rail server.
+
+    Attributes:
+        popularity (PairPopularity): the pairs observed in traffic.
+        top_pairs (number): Optional. how many of the most popular pairs to prefetch.
+        days_ahead (number): Optional. how many days to prefetch, starting today.
+        max_workers (number): Optional. the maximum amount of concurrent requests to the rail server.
+    """
+
+    def __init__(self, popularity, top_pairs=20, days_ahead=3, max_workers=4):
+        self.popularity = popularity
+        self.top_pairs = top_pairs
+        self.days_ahead = days_ahead
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch')
+
+    def run(self, context=None):
+        """Prefetch the days of the popular pairs, can be used as a JobQueue callback."""
+        start = time.perf_counter()
+        today = datetime.date.today()
+        days = [today + datetime.timedelta(days=i) for i in range(self.days_ahead)]
+        jobs = [(origin, dest, day) for origin, dest in self.popularity.top(self.top_pairs) for day in days]
+        failures = sum(1 for succeeded in self._executor.map(self._prefetch_day, jobs) if not succeeded)
+        if train_api.timetable_store is not None:
+            train_api.timetable_store.delete_days_before(today)
+
+        logger.info(f"Prefetched {len(jobs) - failures}/{len(jobs)} days in {time.perf_counter() - start:.3f}s")
+
+    @staticmethod
+    def _prefetch_day(job):
+        try:
+            train_api.refresh_day(*job)
+            return True
+
+        except (AttributeError, ValueError, RuntimeError) as e:
+            logger.warning(f"Failed to prefetch {job}: {e}")
+            return False
+
+
+class SpeculativePrefetcher:
+    """Fetch today's trains of the likely destinations of a user while they are still choosing the destination.
+
+    When a user picks an origin, today of its `top_destinations` most popular destinations is loaded into the routes
+    cache in the background, unless it is already cached. At most `max_in_flight` days are fetched at a time, picks
+    beyond that are not prefetched rather than queued.
+
+    Attributes:
+        popularity (PairPopularity): the pairs observed in traffic.
+        top_destinations (number): Optional. how many of the origin's most popular destinations to prefetch.
+        max_in_flight (number): Optional. the maximum amount of days fetched at the same time.
+    """
+
+    def __init__(self, popularity, top_destinations=3, max_in_flight=4):
+        self.popularity = popularity
+        self.top_destinations = top_destinations
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='speculative-prefetch')
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self.stats = {'fetched': 0, 'failed': 0, 'cached': 0, 'over_budget': 0}
+        # whether the day of the destination the user picked was already cached / still being fetched / not fetched
+        self.picks = {'cached': 0, 'in_flight': 0, 'missed': 0}
+        metrics.CallbackMetric('speculative_prefetches_total', 'Days the speculative prefetch considered, by outcome',
+                               lambda: {(outcome,): value for outcome, value in self.stats.items()},
+                               'counter', ('outcome',))
+        metrics.CallbackMetric('speculative_prefetch_picks_total', "Picked destinations by the state of today's trains",
+                               lambda: {(state,): value for state, value in self.picks.items()},
+                               'counter', ('state',))
+        metrics.CallbackMetric('speculative_prefetch_hit_ratio', 'Ratio of the picked destinations already cached',
+                               self._hit_ratio)
+
+    def origin_selected(self, origin_station_id):
+        """Start prefetching today of the likely destinations of the origin."""
+        today = datetime.date.today()
+        for dest_station_id in self.popularity.top_destinations(origin_station_id, self.top_destinations):
+            key = (int(origin_station_id), dest_station_id, today)
+            with self._lock:
+                if key in self._in_flight:
+                    continue
+
+                if train_api.routes_cache.peek(key) is not None:
+                    self.stats['cached'] += 1
+                    continue
+
+                if not self._slots.acquire(blocking=False):
+                    self.stats['over_budget'] += 1
+                    continue
+
+                self._in_flight.add(key)
+
+            self._executor.submit(self._prefetch_day, key)
+
+    def destination_selected(self, origin_station_id, dest_station_id):
+        """Record whether today of the picked destination is ready, before it is looked up."""
+        key = (int(origin_station_id), int(dest_station_id), datetime.date.today())
+        with self._lock:
+            if train_api.routes_cache.peek(key) is not None:
+                self.picks['cached'] += 1
+
+            elif key in self._in_flight:
+                # the lookup joins the running fetch
+                self.picks['in_flight'] += 1
+
+            else:
+                self.picks['missed'] += 1
+
+    def _prefetch_day(self, key):
+        try:
+            train_api.get_day_timetable(*key)
+            outcome = 'fetched'
+
+        except Exception as e:
+            # nobody waits for this day yet, the user's own lookup reports the error
+            logger.info(f"Failed to prefetch {key}: {e}")
+            outcome = 'failed'
+
+        finally:
+            self._slots.release()
+
+        with self._lock:
+            self._in_flight.discard(key)
+            self.stats[outcome] += 1
+
+    def _hit_ratio(self):
+        picks = sum(self.picks.values())
+        return 0 if picks == 0 else self.picks['cached'] / picks
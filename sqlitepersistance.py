@@ -0,0 +1,87 @@
+import json
+import sqlite3
+import threading
+
+from persistence import IncrementalPersistence
+
+
+class SqlitePersistence(IncrementalPersistence):
+    """Persist the bot's user data, chat data and conversations in a local SQLite (WAL mode) database.
+
+    Every user, chat and conversation key is a row, the rows of a user or chat are read when it is first used and the
+    changed rows are written in a single transaction, see :class:`persistence.IncrementalPersistence`.
+
+    Attributes:
+        path (str): path of the SQLite database file.
+        max_cached_users (number): Optional. the amount of users (and of chats) whose data is kept in memory.
+    """
+    BACKEND = 'sqlite'
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS chat_data (
+            chat_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            PRIMARY KEY (name, key)
+        );
+    '''
+
+    def __init__(self, path, max_cached_users=10000):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(self.SCHEMA)
+        super().__init__(max_cached_users)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared between threads, every worker thread opens its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+
+        return connection
+
+    def _fetch_user_data(self, user_id):
+        row = self._connection().execute('SELECT data FROM user_data WHERE user_id = ?', (user_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _fetch_chat_data(self, chat_id):
+        row = self._connection().execute('SELECT data FROM chat_data WHERE chat_id = ?', (chat_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _fetch_conversations(self):
+        conversations = {}
+        for name, key, state in self._connection().execute('SELECT name, key, state FROM conversations'):
+            conversations.setdefault(name, {})[tuple(json.loads(key))] = json.loads(state)
+
+        return conversations
+
+    def _write(self, user_data, chat_data, conversations):
+        connection = self._connection()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO user_data VALUES (?, ?)',
+                                   [(user_id, json.dumps(data)) for user_id, data in user_data.items()
+                                    if data is not None])
+            connection.executemany('DELETE FROM user_data WHERE user_id = ?',
+                                   [(user_id,) for user_id, data in user_data.items() if data is None])
+            connection.executemany('INSERT OR REPLACE INTO chat_data VALUES (?, ?)',
+                                   [(chat_id, json.dumps(data)) for chat_id, data in chat_data.items()
+                                    if data is not None])
+            connection.executemany('DELETE FROM chat_data WHERE chat_id = ?',
+                                   [(chat_id,) for chat_id, data in chat_data.items() if data is None])
+            connection.executemany('INSERT OR REPLACE INTO conversations VALUES (?, ?, ?)',
+                                   [(name, json.dumps(key), json.dumps(state))
+                                    for (name, key), state in conversations.items() if state is not None])
+            connection.executemany('DELETE FROM conversations WHERE name = ? AND key = ?',
+                                   [(name, json.dumps(key)) for (name, key), state in conversations.items()
+                                    if state is None])
@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+from queue import Queue
+
+from telegram import Bot
+from telegram import Update
+from telegram.ext import Dispatcher
+from telegram.ext import Filters
+from telegram.ext import MessageHandler
+from telegram.utils.promise import Promise
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from persistence import IncrementalPersistence  # noqa: E402
+from persistence import LazyDict  # noqa: E402
+from worker_pools import WorkerPool  # noqa: E402
+
+
+class InMemoryPersistence(IncrementalPersistence):
+    """Persistence keeping the written data in dicts, recording every write."""
+    BACKEND = 'memory'
+
+    def __init__(self, stored_user_data=None, **kwargs):
+        self.stored_user_data = dict(stored_user_data or {})
+        self.stored_chat_data = {}
+        self.stored_conversations = {}
+        self.writes = []
+        super().__init__(**kwargs)
+
+    def _fetch_user_data(self, user_id):
+        return self.stored_user_data.get(user_id)
+
+    def _fetch_chat_data(self, chat_id):
+        return self.stored_chat_data.get(chat_id)
+
+    def _fetch_conversations(self):
+        return {}
+
+    def _write(self, user_data, chat_data, conversations):
+        self.writes.append((user_data, chat_data, conversations))
+        self.stored_user_data.update(user_data)
+        self.stored_chat_data.update(chat_data)
+        self.stored_conversations.update(conversations)
+
+
+def message_update(update_id, user_id, text):
+    return Update.de_json({'update_id': update_id,
+                           'message': {'message_id': update_id,
+                                       'date': 0,
+                                       'text': text,
+                                       'from': {'id': user_id, 'is_bot': False, 'first_name': 'user'},
+                                       'chat': {'id': user_id, 'type': 'private'}}},
+                          None)
+
+
+def dispatcher_with(persistence):
+    dispatcher = Dispatcher(Bot('123:abc'), Queue(), workers=1, persistence=persistence, use_context=True)
+
+    pool = WorkerPool('handlers', max_workers=1, max_queued=10)
+
+    def save_id(update, context):
+        # on a worker pool like the bot's handlers, the dispatcher persists the update before the data changes
+        def handle():
+            time.sleep(0.05)
+            context.user_data['id'] = update.message.text
+
+        pool.submit(handle)
+
+    dispatcher.add_handler(MessageHandler(Filters.text, save_id))
+    return dispatcher
+
+
+def wait_for_handler(dispatcher, update):
+    deadline = time.monotonic() + 5
+    while dispatcher.user_data[update.effective_user.id].get('id') != update.message.text:
+        assert time.monotonic() < deadline, 'the handler did not run'
+        time.sleep(0.01)
+
+
+def test_checkpoint_writes_user_data_changed_by_a_handler():
+    persistence = InMemoryPersistence()
+    dispatcher = dispatcher_with(persistence)
+    update = message_update(1, 1, '111')
+    dispatcher.process_update(update)
+    # a checkpoint running while the handler is still running
+    persistence.checkpoint()
+    wait_for_handler(dispatcher, update)
+    persistence.checkpoint()
+    assert persistence.stored_user_data[1] == {'id': '111'}
+
+
+def test_checkpoint_skips_unchanged_users():
+    persistence = InMemoryPersistence(stored_user_data={1: {'id': '111'}})
+    dispatcher = dispatcher_with(persistence)
+    update = message_update(1, 1, '111')
+    dispatcher.process_update(update)
+    wait_for_handler(dispatcher, update)
+    persistence.checkpoint()
+    assert persistence.writes == []
+
+
+def test_checkpoint_keeps_the_state_of_a_failed_handler():
+    persistence = InMemoryPersistence()
+
+    def fail():
+        raise ValueError('handler failed')
+
+    promise = Promise(fail, (), {})
+    persistence.update_conversation('conversation', (1, 1), ('MAIN', promise))
+    persistence.update_user_data(2, {'id': '222'})
+    promise.run()
+    persistence.checkpoint()
+    assert persistence.stored_conversations == {('conversation', (1, 1)): 'MAIN'}
+    assert persistence.stored_user_data == {2: {'id': '222'}}
+    # already done when the dispatcher persists it
+    persistence.update_conversation('conversation', (3, 3), ('MAIN', promise))
+    assert persistence.conversations['conversation'][(3, 3)] == 'MAIN'
+
+
+def test_lazy_dict_keeps_unwritten_and_recently_used_ids():
+    now = [0]
+    stored = {1: {'id': '111'}}
+    data = LazyDict(stored.get, max_size=1, is_dirty=lambda key: False, idle_seconds=300, clock=lambda: now[0])
+    data[1]['id'] = '222'
+    now[0] = 400
+    data[2]['id'] = '333'
+    data.evict()
+    # changed and not written yet
+    assert data.get(1) == {'id': '222'}
+
+    data.mark_written(1, {'id': '222'})
+    data.mark_written(2, {'id': '333'})
+    now[0] = 500
+    data[3]
+    data.evict()
+    # written, but used 100 seconds ago
+    assert 1 not in data
+    assert 2 in data
+
+    now[0] = 800
+    data[3]
+    data.evict()
+    assert 2 not in data
+    assert data.stats['evictions'] == 2
+
+
+def test_lazy_dict_over_its_size_can_be_iterated_and_indexed():
+    data = LazyDict(lambda key: None, max_size=2, is_dirty=lambda key: False)
+    for user_id in range(5):
+        data.mark_written(user_id, data[user_id])
+
+    # like the dispatcher persisting every user on shutdown
+    for user_id in data:
+        data[user_id] = data[user_id]
+
+    assert sorted(data) == list(range(5))
@@ -0,0 +1,97 @@
+import datetime
+import json
+import sqlite3
+import threading
+import time
+
+import train_api
+
+
+class TimetableStore:
+    """Local SQLite (WAL mode) store of the days fetched from GetRoutes.
+
+    Every train of a stored day is a row indexed by (origin, destination, date, departure), so a day is read back
+    with one indexed query instead of a request to the rail server.
+
+    Attributes:
+        path (str): path of the SQLite database file.
+        max_age (number): Optional. seconds a stored day is used before it has to be fetched again.
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS days (
+            origin INTEGER NOT NULL,
+            destination INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (origin, destination, date)
+        );
+        CREATE TABLE IF NOT EXISTS trains (
+            origin INTEGER NOT NULL,
+            destination INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            departure TEXT NOT NULL,
+            route_index INTEGER NOT NULL,
+            leg_index INTEGER NOT NULL,
+            train TEXT NOT NULL,
+            PRIMARY KEY (origin, destination, date, route_index, leg_index)
+        );
+        CREATE INDEX IF NOT EXISTS trains_by_departure ON trains (origin, destination, date, departure);
+    '''
+
+    def __init__(self, path, max_age=60 * 60):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections cannot be shared between threads, every worker thread opens its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+
+        return connection
+
+    def load(self, origin_station_id, dest_station_id, date: datetime.date):
+        """Load a stored day.
+
+        Returns:
+            train_api.DayTimetable. the routes of the day, or None if the day is not stored or is older than max_age.
+        """
+        key = (int(origin_station_id), int(dest_station_id), str(date))
+        connection = self._connection()
+        day = connection.execute('SELECT fetched_at FROM days WHERE origin = ? AND destination = ? AND date = ?',
+                                 key).fetchone()
+        if day is None or time.time() - day[0] > self.max_age:
+            return None
+
+        rows = connection.execute('SELECT route_index, train FROM trains '
+                                  'WHERE origin = ? AND destination = ? AND date = ? '
+                                  'ORDER BY departure, route_index, leg_index', key)
+        routes = {}
+        for route_index, train in rows:
+            routes.setdefault(route_index, []).append(train_api.Train.from_json(json.loads(train)))
+
+        return train_api.DayTimetable(train_api.Route(trains=tuple(trains)) for trains in routes.values())
+
+    def save(self, origin_station_id, dest_station_id, date: datetime.date, timetable):
+        """Replace a stored day with the routes of the timetable in a single transaction."""
+        key = (int(origin_station_id), int(dest_station_id), str(date))
+        rows = [key + (train.departure_datetime.isoformat(), route_index, leg_index, json.dumps(train.to_dict()))
+                for route_index, route in enumerate(timetable.routes)
+                for leg_index, train in enumerate(route.trains)]
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM trains WHERE origin = ? AND destination = ? AND date = ?', key)
+            connection.executemany('INSERT INTO trains VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            connection.execute('INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?)', key + (time.time(),))
+
+    def delete_days_before(self, date: datetime.date):
+        """Remove the days before the date, they are never asked for again."""
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM trains WHERE date < ?', (str(date),))
+            connection.execute('DELETE FROM days WHERE date < ?', (str(date),))
@@ -1,17 +1,40 @@
 import base64
 import datetime
+import io
 import json
 import os
+import random
 import re
+import threading
+import time
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from json import JSONDecodeError
 from operator import attrgetter
+from typing import Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from cache import SingleFlight
+from cache import TTLCache
 
 MOBILE_PLACEHOLDER = "0123456789"
 
-proxies = {'https': os.getenv('RAIL_PROXY')}
+# Can point to a local stand-in of the rail server, e.g. benchmarks/stub_rail_server.py
+RAIL_SERVER_URL = os.getenv('RAIL_SERVER_URL', 'https://www.rail.co.il')
+
+ROUTES_CACHE_SIZE = 2048
+ROUTES_CACHE_TTL = 120  # seconds
+ROUTES_CACHE_STALE_TTL = 15 * 60  # seconds
+
+# days of a scan requested ahead of the earliest day not fetched yet
+SCAN_WINDOW = 3
 
 stations_info = {
     3700: {'Code': '3700',
@@ -426,14 +449,330 @@ stations_info = {
            'ID': '70'}}
 
 
+STATION_NAME_LANGUAGES = ('HE', 'EN', 'AR', 'RU')
+_STATION_NAME_QUOTES = re.compile(r'["\'״׳`]+')
+_STATION_NAME_SEPARATORS = re.compile(r'[\s.,()/-]+')
+
+
+def _normalize_station_name(name):
+    return _STATION_NAME_SEPARATORS.sub(' ', _STATION_NAME_QUOTES.sub('', name)).strip().lower()
+
+
+def _trigrams(normalized_name):
+    padded = f"  {normalized_name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _build_station_indexes():
+    ids_by_name = {language: {} for language in STATION_NAME_LANGUAGES}
+    ids_by_normalized_name = {}
+    ids_by_prefix = defaultdict(set)
+    ids_by_trigram = defaultdict(set)
+    for station_id, station in stations_info.items():
+        for language in STATION_NAME_LANGUAGES:
+            ids_by_name[language][station[language]] = station_id
+            normalized_name = _normalize_station_name(station[language])
+            ids_by_normalized_name.setdefault(normalized_name, station_id)
+            # Index the prefixes of the whole name and of every word in it, e.g. "haif" and "cent" for "haifa center"
+            for word_start in [0] + [match.end() for match in re.finditer(' ', normalized_name)]:
+                for end in range(word_start + 1, len(normalized_name) + 1):
+                    ids_by_prefix[normalized_name[word_start:end]].add(station_id)
+
+            for trigram in _trigrams(normalized_name):
+                ids_by_trigram[trigram].add(station_id)
+
+    return ids_by_name, ids_by_normalized_name, dict(ids_by_prefix), dict(ids_by_trigram)
+
+
+# Precomputed once, every station lookup is a dict access instead of a scan over stations_info.
+(_station_ids_by_name,
+ _station_ids_by_normalized_name,
+ _station_ids_by_prefix,
+ _station_ids_by_trigram) = _build_station_indexes()
+
+station_names = sorted(_station_ids_by_name['HE'])
+station_names_set = frozenset(station_names)
+
+
 class TrainSeatError(Exception):
     def __init__(self, remote_error_message):
         self.message = remote_error_message
         super().__init__()
 
 
+class RailServerUnavailableError(RuntimeError):
+    """The rail server did not respond, or it failed too many times recently and is not called for a while."""
+
+
+class CircuitBreaker:
+    """Stop calling an unhealthy endpoint for a while instead of waiting for it to time out on every call.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls fail immediately. After `reset_timeout`
+    seconds a single trial call is let through (half open), its success closes the circuit and its failure opens it
+    again.
+
+    Attributes:
+        name (str): the name of the protected endpoint.
+        failure_threshold (number): Optional. consecutive failures that open the circuit.
+        reset_timeout (number): Optional. seconds the circuit stays open before a trial call.
+        stats (dict): how many calls were made in each state, how many were rejected and how many times the circuit
+            opened.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self.stats = {self.CLOSED: 0, self.HALF_OPEN: 0, 'rejected': 0, 'failures': 0, 'opened': 0}
+
+    def before_call(self):
+        """Check the call may be made.
+
+        Raises:
+            RailServerUnavailableError: the circuit is open.
+        """
+        with self._lock:
+            if self.state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._trial_running):
+                self.stats['rejected'] += 1
+                raise RailServerUnavailableError(f'{self.name} is unavailable, not calling it for a while')
+
+            if self.state == self.HALF_OPEN:
+                self._trial_running = True
+
+            self.stats[self.state] += 1
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self.stats['failures'] += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.stats['opened'] += 1
+
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+                self._trial_running = False
+
+
+rail_request_seconds = metrics.Histogram('rail_request_seconds', 'Latency of the calls to the rail server',
+                                         ('endpoint', 'outcome'))
+
+
+class RailClient:
+    """HTTP client for the rail server, keeping pooled keep-alive connections between calls.
+
+    Each endpoint has its own timeout and circuit breaker. Route lookups are idempotent so they are retried with a
+    jittered exponential backoff, voucher orders are never retried.
+
+    Attributes:
+        pool_size (number): the maximum amount of open connections per host, should match the amount of threads
+            that may call the rail server at the same time.
+        proxies (dict): Optional. proxies to use for every request (both route lookups and voucher orders), by
+            default the https proxy is taken from the `RAIL_PROXY` env var.
+        routes_timeout (number / tuple): Optional. timeout in seconds (or (connect, read) tuple) for route lookups.
+        voucher_timeout (number / tuple): Optional. timeout in seconds (or (connect, read) tuple) for voucher orders.
+        routes_retries (number): Optional. how many times a failed route lookup is retried.
+        retry_backoff (number): Optional. base seconds to wait before a retry, doubled on every retry.
+        failure_threshold (number): Optional. consecutive failures of an endpoint that open its circuit.
+        reset_timeout (number): Optional. seconds an open circuit fails fast before trying the endpoint again.
+    """
+    DEFAULT_POOL_SIZE = 10
+
+    def __init__(self,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 proxies=None,
+                 routes_timeout=(5, 15),
+                 voucher_timeout=(5, 30),
+                 routes_retries=2,
+                 retry_backoff=0.5,
+                 failure_threshold=5,
+                 reset_timeout=30):
+        if proxies is None:
+            proxies = {'https': os.getenv('RAIL_PROXY')}
+
+        self.pool_size = pool_size
+        self.proxies = proxies
+        self.routes_timeout = routes_timeout
+        self.voucher_timeout = voucher_timeout
+        self.routes_retries = routes_retries
+        self.retry_backoff = retry_backoff
+        self.routes_breaker = CircuitBreaker('GetRoutes', failure_threshold, reset_timeout)
+        self.voucher_breaker = CircuitBreaker('ReservedPlaceHandler', failure_threshold, reset_timeout)
+        self.retries = 0
+        # retries happen on many threads at once, rarely enough for a lock
+        self._retries_lock = threading.Lock()
+        self.session = self._create_session()
+
+    def _create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Connection'] = 'keep-alive'
+        session.proxies.update({scheme: url for scheme, url in self.proxies.items() if url})
+        return session
+
+    @property
+    def stats(self):
+        return {'retries': self.retries,
+                self.routes_breaker.name: dict(self.routes_breaker.stats),
+                self.voucher_breaker.name: dict(self.voucher_breaker.stats)}
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.routes_timeout)
+        return self._call(self.routes_breaker, self.session.get, url, self.routes_retries, **kwargs)
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.voucher_timeout)
+        return self._call(self.voucher_breaker, self.session.post, url, 0, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def _call(self, breaker, method, url, retries, **kwargs):
+        """Call an endpoint through its circuit breaker, retrying request errors (e.g. connection errors and timeouts)
+        and server errors.
+
+        Raises:
+            RailServerUnavailableError: the circuit is open or all the attempts failed.
+        """
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                with self._retries_lock:
+                    self.retries += 1
+
+                # Full jitter, so the retries of many callers do not hit the server at the same moment
+                time.sleep(random.uniform(0, self.retry_backoff * 2 ** (attempt - 1)))
+
+            breaker.before_call()
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                res = method(url, **kwargs)
+                if res.status_code < 500:
+                    outcome = 'ok'
+
+                else:
+                    error = requests.HTTPError(f'{breaker.name} responded with status {res.status_code}', response=res)
+
+            except requests.RequestException as e:
+                error = e
+
+            finally:
+                # every outcome is recorded, even unexpected errors, so a half open circuit does not wait for a trial
+                # call that already ended
+                rail_request_seconds.labels(endpoint=breaker.name, outcome=outcome).observe(time.perf_counter() - start)
+                if outcome == 'ok':
+                    breaker.record_success()
+
+                else:
+                    breaker.record_failure()
+
+            if outcome == 'ok':
+                return res
+
+        raise RailServerUnavailableError(f'{breaker.name} failed after {retries + 1} attempts') from error
+
+
+client = RailClient()
+
+
+def configure_client(**kwargs):
+    """Replace the module rail client with a new one, closing the connections of the old one.
+
+    Args:
+        kwargs: arguments passed to :class:`RailClient`.
+
+    Returns:
+        RailClient. the new client.
+    """
+    global client
+    old_client, client = client, RailClient(**kwargs)
+    old_client.close()
+    return client
+
+
+routes_cache = TTLCache(max_size=ROUTES_CACHE_SIZE, ttl=ROUTES_CACHE_TTL, stale_ttl=ROUTES_CACHE_STALE_TTL)
+# Every request of a day to the rail server, whether a cache miss, a background refresh or a prefetch, joins the
+# running request of the same day
+routes_flight = SingleFlight()
+# Optional local store the days are read through, see `configure_timetable_store`
+timetable_store = None
+
+
+def _circuit_calls():
+    return {(breaker.name, counted): value
+            for breaker in (client.routes_breaker, client.voucher_breaker)
+            for counted, value in breaker.stats.items()}
+
+
+def _routes_cache_hit_ratio():
+    stats = routes_cache.stats
+    lookups = stats['hits'] + stats['stale_hits'] + stats['misses'] + stats['joined']
+    return 0 if lookups == 0 else (stats['hits'] + stats['stale_hits']) / lookups
+
+
+metrics.CallbackMetric('rail_circuit_calls_total', 'Calls through the rail circuit breakers, by state or outcome',
+                       _circuit_calls, 'counter', ('endpoint', 'counted'))
+metrics.CallbackMetric('rail_retries_total', 'Retried route lookups', lambda: client.retries, 'counter')
+metrics.CallbackMetric('routes_cache_lookups_total', 'Lookups of the routes cache by result',
+                       lambda: {(result,): value for result, value in routes_cache.stats.items()
+                                if result != 'evictions'}, 'counter', ('result',))
+metrics.CallbackMetric('routes_cache_evictions_total', 'Days evicted from the routes cache',
+                       lambda: routes_cache.stats['evictions'], 'counter')
+metrics.CallbackMetric('routes_cache_hit_ratio', 'Ratio of the routes cache lookups served from the cache',
+                       _routes_cache_hit_ratio)
+metrics.CallbackMetric('routes_cache_size', 'Days kept in the routes cache', lambda: len(routes_cache))
+metrics.CallbackMetric('rail_route_requests_total', 'Route lookups sent to the rail server',
+                       lambda: routes_flight.stats['calls'], 'counter')
+metrics.CallbackMetric('rail_route_lookups_coalesced_total',
+                       'Route lookups that joined a running lookup of the same day instead of calling the rail server',
+                       lambda: {('cache',): routes_cache.stats['joined'], ('request',): routes_flight.stats['joined']},
+                       'counter', ('layer',))
+
+
+def _parse_train_datetime(train_time):
+    """Parse a rail server timestamp (e.g. "05/10/2020 18:35:00"), much faster than `datetime.strptime`."""
+    if len(train_time) != 19:
+        return datetime.datetime.strptime(train_time, "%d/%m/%Y %H:%M:%S")
+
+    return datetime.datetime.fromisoformat(f"{train_time[6:10]}-{train_time[3:5]}-{train_time[0:2]}T{train_time[11:]}")
+
+
 @dataclass
 class Train:
+    __slots__ = ('departure_datetime',
+                 'arrival_datetime',
+                 'origin_station_id',
+                 'destination_station_id',
+                 'train_number',
+                 'destination_platform',
+                 'platform',
+                 'is_full_train',
+                 # Formatted once, they are read for every train on every trains keyboard
+                 'departure_time',
+                 'departure_date',
+                 'arrival_time',
+                 'arrival_date')
+
     departure_datetime: datetime.datetime
     arrival_datetime: datetime.datetime
     origin_station_id: int
@@ -443,10 +782,17 @@ class Train:
     platform: int
     is_full_train: bool
 
+    def __post_init__(self):
+        departure, arrival = self.departure_datetime, self.arrival_datetime
+        self.departure_time = f"{departure.hour:02d}:{departure.minute:02d}"
+        self.departure_date = f"{departure.day:02d}/{departure.month:02d}/{departure.year}"
+        self.arrival_time = f"{arrival.hour:02d}:{arrival.minute:02d}"
+        self.arrival_date = f"{arrival.day:02d}/{arrival.month:02d}/{arrival.year}"
+
     @classmethod
     def from_json(cls, train_dict):
-        arrival_time = Train._train_arrival_datetime(train_dict["ArrivalTime"])
-        departure_time = Train._train_arrival_datetime(train_dict["DepartureTime"])
+        arrival_time = _parse_train_datetime(train_dict["ArrivalTime"])
+        departure_time = _parse_train_datetime(train_dict["DepartureTime"])
         return cls(departure_datetime=departure_time,
                    arrival_datetime=arrival_time,
                    origin_station_id=int(train_dict["OrignStation"]),
@@ -477,23 +823,7 @@ class Train:
 
     @staticmethod
     def _train_arrival_datetime(train_time):
-        return datetime.datetime.strptime(train_time, "%d/%m/%Y %H:%M:%S")
-
-    @property
-    def arrival_time(self):
-        return self.arrival_datetime.time().strftime("%H:%M")
-
-    @property
-    def arrival_date(self):
-        return self.arrival_datetime.date().strftime("%d/%m/%Y")
-
-    @property
-    def departure_time(self):
-        return self.departure_datetime.time().strftime("%H:%M")
-
-    @property
-    def departure_date(self):
-        return self.departure_datetime.date().strftime("%d/%m/%Y")
+        return _parse_train_datetime(train_time)
 
     @property
     def printable_arrival_time(self):
@@ -520,58 +850,425 @@ class Train:
         return f"{origin_station} -> {dest_station}, {train_times}"
 
 
-def train_station_name_to_id(train_name):
-    return next(idx for idx, train in stations_info.items() if train['HE'] == train_name)
+@dataclass
+class Route:
+    """A journey from the origin to the destination station, made of one train or several connecting trains."""
+    __slots__ = ('trains',)
+
+    trains: Tuple[Train, ...]
+
+    @classmethod
+    def from_json(cls, route_dict):
+        return cls(trains=tuple(Train.from_json(train_dict) for train_dict in route_dict['Train']))
+
+    def to_dict(self):
+        return {'Train': [train.to_dict() for train in self.trains]}
+
+    @property
+    def is_direct(self):
+        return len(self.trains) == 1
+
+    @property
+    def departure_datetime(self):
+        return self.trains[0].departure_datetime
+
+    @property
+    def arrival_datetime(self):
+        return self.trains[-1].arrival_datetime
+
+    @property
+    def origin_station_id(self):
+        return self.trains[0].origin_station_id
+
+    @property
+    def destination_station_id(self):
+        return self.trains[-1].destination_station_id
+
+    @property
+    def train_numbers(self):
+        return tuple(train.train_number for train in self.trains)
+
+    def get_printable_travel_time(self):
+        travel_time = f"{self.trains[0].departure_time} - {self.trains[-1].arrival_time}"
+        if self.is_direct:
+            return travel_time
+
+        changes = len(self.trains) - 1
+        return f"{travel_time} ({changes} change{'s' if changes > 1 else ''})"
+
+    def __str__(self):
+        return '\n\n'.join(str(train) for train in self.trains)
+
+
+class DayTimetable:
+    """All the routes and trains of one (origin, destination, date), indexed once for fast queries.
+
+    The routes and the trains are kept sorted by departure, so "next departure after" and range queries are binary
+    searches, and trains are indexed by their number and by their departure time.
+
+    Attributes:
+        routes (list): the routes of the day sorted by departure.
+        trains (list): the trains of all the routes sorted by departure.
+    """
+
+    def __init__(self, routes):
+        self.routes = sorted(routes, key=attrgetter('departure_datetime'))
+        self.trains = sorted((train for route in self.routes for train in route.trains),
+                             key=attrgetter('departure_datetime'))
+        self._route_departures = [route.departure_datetime for route in self.routes]
+        self._train_departures = [train.departure_datetime for train in self.trains]
+        self._routes_by_train_numbers = {route.train_numbers: route for route in self.routes}
+        self._trains_by_number = {}
+        self._trains_by_departure = defaultdict(list)
+        for train in self.trains:
+            self._trains_by_number.setdefault(train.train_number, train)
+            self._trains_by_departure[train.departure_datetime].append(train)
+
+    def __len__(self):
+        return len(self.routes)
+
+    def routes_after(self, date: datetime.datetime):
+        """Return the routes departing at `date` or later."""
+        return self.routes[bisect_left(self._route_departures, date):]
+
+    def trains_after(self, date: datetime.datetime):
+        """Return the trains departing at `date` or later."""
+        return self.trains[bisect_left(self._train_departures, date):]
+
+    def trains_between(self, start: datetime.datetime, end: datetime.datetime):
+        """Return the trains departing from `start` (inclusive) to `end` (exclusive)."""
+        return self.trains[bisect_left(self._train_departures, start):bisect_left(self._train_departures, end)]
+
+    def next_train_after(self, date: datetime.datetime, inclusive=True):
+        """Return the first train departing after `date` (or at `date` when inclusive), None if there is none."""
+        index = (bisect_left if inclusive else bisect_right)(self._train_departures, date)
+        return self.trains[index] if index < len(self.trains) else None
+
+    def train_by_number(self, train_number):
+        return self._trains_by_number.get(int(train_number))
+
+    def route_by_train_numbers(self, train_numbers):
+        """Return the route made of the trains with these numbers (in order), None if there is none."""
+        return self._routes_by_train_numbers.get(tuple(int(train_number) for train_number in train_numbers))
+
+    def trains_departing_at(self, date: datetime.datetime):
+        return list(self._trains_by_departure.get(date, ()))
+
+    def first_available_train(self, date: datetime.datetime = None):
+        """Return the first train departing at `date` or later that has not left yet, None if there is none."""
+        now = datetime.datetime.now()
+        if date is None or date <= now:
+            return self.next_train_after(now, inclusive=False)
+
+        return self.next_train_after(date)
+
+
+def train_station_name_to_id(train_name, language='HE'):
+    return _station_ids_by_name[language][train_name]
+
+
+def search_stations(query, limit=10, min_similarity=0.3):
+    """Find the stations matching a partial or misspelled name in any of the supported languages.
+
+    Stations are ranked by an exact name match first, then a prefix match of the name or one of its words, then by
+    the part of the query trigrams found in the station names.
+
+    Args:
+        query (str): the name typed by the user (e.g. "haif" or "חיפ").
+        limit (number): Optional. the maximum amount of stations returned.
+        min_similarity (float): Optional. the minimal part of the query trigrams a fuzzy match must contain.
+
+    Returns:
+        list. ids of the matching stations, best match first.
+    """
+    normalized_query = _normalize_station_name(query)
+    if normalized_query == '':
+        return []
+
+    scores = {}
+    query_trigrams = _trigrams(normalized_query)
+    trigram_counts = defaultdict(int)
+    for trigram in query_trigrams:
+        for station_id in _station_ids_by_trigram.get(trigram, ()):
+            trigram_counts[station_id] += 1
+
+    for station_id, count in trigram_counts.items():
+        similarity = count / len(query_trigrams)
+        if similarity >= min_similarity:
+            scores[station_id] = similarity
+
+    for station_id in _station_ids_by_prefix.get(normalized_query, ()):
+        scores[station_id] = 2 + scores.get(station_id, 0)
+
+    exact_match = _station_ids_by_normalized_name.get(normalized_query)
+    if exact_match is not None:
+        scores[exact_match] = 4
+
+    ranked = sorted(scores, key=lambda station_id: (-scores[station_id], stations_info[station_id]['HE']))
+    return ranked[:limit]
 
 
 def train_station_id_to_name(train_id):
     return stations_info[train_id]['HE']
 
 
-def get_all_trains_for_today(origin_station_id, dest_station_id, date: datetime.date = None):
-    """Get a generator of all the trains that were available today, from 00:00 to 00:00.
+def _routes_url(origin_station_id, dest_station_id, date: datetime.date):
+    date_formatted = str(date).replace("-", "")
+    return (f"{RAIL_SERVER_URL}/apiinfo/api/Plan/GetRoutes"
+            f"?OId={origin_station_id}"
+            f"&TId={dest_station_id}"
+            f"&Date={date_formatted}"
+            f"&Hour=0000"
+            "&isGoing=true"
+            f"&c={str(round(datetime.datetime.now().timestamp(), 3)).replace('.', '')}")
+
+
+def _iter_routes_body(body):
+    if 'Data' not in body or 'Routes' not in body['Data']:
+        raise ValueError('Received JSON has no attribute "Data" or "Routes"')
+
+    for route_dict in body['Data']['Routes']:
+        yield Route.from_json(route_dict)
+
+
+def _fetch_routes(origin_station_id, dest_station_id, date: datetime.date):
+    """Fetch all the routes of a day from the rail server, joining a running request of the same day.
+
+    The timetable is shared by all the callers, they filter it without changing it (e.g. `DayTimetable.trains_after`).
+
+    Returns:
+        DayTimetable. the routes of the day.
+    """
+    key = _routes_cache_key(origin_station_id, dest_station_id, date)
+    return routes_flight.do(key, lambda: _request_routes(*key))
+
+
+def _request_routes(origin_station_id, dest_station_id, date: datetime.date):
+    res = client.get(_routes_url(origin_station_id, dest_station_id, date))
+    try:
+        body = res.json()
+
+    except JSONDecodeError:
+        raise AttributeError('No JSON received. some of the request parameters might be wrong')
+
+    return DayTimetable(_iter_routes_body(body))
+
+
+def _routes_cache_key(origin_station_id, dest_station_id, date):
+    if date is None:
+        date = datetime.datetime.now().date()
+
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+
+    return int(origin_station_id), int(dest_station_id), date
+
+
+def _fetch_and_store_routes(origin_station_id, dest_station_id, date: datetime.date):
+    timetable = _fetch_routes(origin_station_id, dest_station_id, date)
+    if timetable_store is not None:
+        timetable_store.save(origin_station_id, dest_station_id, date, timetable)
+
+    return timetable
+
+
+def _load_routes(origin_station_id, dest_station_id, date: datetime.date):
+    """Load the routes of a day from the local timetable store, or from the rail server if it is not stored."""
+    if timetable_store is not None:
+        timetable = timetable_store.load(origin_station_id, dest_station_id, date)
+        if timetable is not None:
+            return timetable
+
+    return _fetch_and_store_routes(origin_station_id, dest_station_id, date)
+
+
+def refresh_day(origin_station_id, dest_station_id, date: datetime.date = None):
+    """Fetch a day from the rail server, replacing it in the routes cache and in the local timetable store.
+
+    Returns:
+        DayTimetable. the routes and trains of the day.
+    """
+    key = _routes_cache_key(origin_station_id, dest_station_id, date)
+    timetable = _fetch_and_store_routes(*key)
+    routes_cache.put(key, timetable)
+    return timetable
+
+
+def configure_timetable_store(store):
+    """Read and write the fetched days through a local store (e.g. `timetable_store.TimetableStore`).
+
+    Args:
+        store: object with `load(origin, dest, date)` and `save(origin, dest, date, timetable)` methods, or None to
+            always fetch from the rail server.
+    """
+    global timetable_store
+    timetable_store = store
+
+
+def get_day_timetable(origin_station_id, dest_station_id, date: datetime.date = None, allow_stale=False):
+    """Get the timetable of all the routes of the day, from 00:00 to 00:00.
+
+    The timetable of each (origin, destination, date) is cached for `ROUTES_CACHE_TTL` seconds, concurrent calls for
+    the same day share a single request to the rail server. If a timetable store is configured, cache misses are read
+    from it before calling the rail server, while expired days are refreshed from the rail server.
 
     Args:
         origin_station_id (number): the origin station id.
         dest_station_id (number): the destination station id.
         date (datetime.datetime): Optional. the date of the day, the time does not matter. if not supplied the date
             is today.
+        allow_stale (bool): Optional. whether to return an expired cached day (up to `ROUTES_CACHE_STALE_TTL`
+            seconds) immediately while it is refreshed in the background.
+
+    Returns:
+        DayTimetable. the routes and trains of the day.
+
+    Raises:
+        AttributeError: If some of the parameters are wrong.
+        ValueError: The result from the server is missing.
+        RailServerUnavailableError: The rail server is not responding.
+    """
+    key = _routes_cache_key(origin_station_id, dest_station_id, date)
+    # the stored copy of an expired day may be older than the day in the cache
+    return routes_cache.get_or_load(key, lambda: _load_routes(*key), allow_stale=allow_stale,
+                                    refresh_loader=lambda: _fetch_and_store_routes(*key))
+
+
+def get_all_routes_for_today(origin_station_id, dest_station_id, date: datetime.date = None, allow_stale=False):
+    """Get a generator of all the routes of the day sorted by departure, from 00:00 to 00:00.
+
+    Args:
+        origin_station_id (number): the origin station id.
+        dest_station_id (number): the destination station id.
+        date (datetime.datetime): Optional. the date of the day, the time does not matter. if not supplied the date
+            is today.
+        allow_stale (bool): Optional. whether an expired cached day can be used, see `get_day_timetable`.
 
     Yields:
-        Train. train object contains all the data of the train.
+        Route. the route and its ordered trains.
 
     Raises:
         AttributeError: If some of the parameters are wrong.
         ValueError: The result from the server is missing.
     """
+    yield from get_day_timetable(origin_station_id, dest_station_id, date, allow_stale=allow_stale).routes
+
+
+def get_available_routes(origin_station_id, dest_station_id, date: datetime.datetime = None, allow_stale=False):
+    """Get a generator of all the routes departing from the current date and on.
+
+    Args:
+        origin_station_id (number): the origin station id.
+        dest_station_id (number): the destination station id.
+        date (datetime.datetime): Optional. the day and time to get ongoing routes and on. if not supplied the date
+            is now.
+        allow_stale (bool): Optional. whether an expired cached day can be used, see `get_day_timetable`.
+
+    Yields:
+        Route. the route and its ordered trains.
+    """
     if date is None:
-        date = datetime.datetime.now().date()
+        date = datetime.datetime.now()
 
-    date_formatted = str(date).replace("-", "")
+    yield from get_day_timetable(origin_station_id, dest_station_id, date.date(), allow_stale).routes_after(date)
+
+
+def get_first_day_with_routes(origin_station_id,
+                              dest_station_id,
+                              days,
+                              executor,
+                              window=SCAN_WINDOW,
+                              allow_stale=False,
+                              on_fetched=None):
+    """Get the available routes of the first of the days that has any (e.g. the trains list of the next week).
+
+    The days are fetched concurrently on the executor, up to `window` days ahead of the earliest day not fetched yet.
+    Once a day with routes is found the later days were mostly not requested yet, the ones still waiting for a worker
+    are cancelled (the requests already running are not stopped).
+
+    Args:
+        origin_station_id (number): the origin station id.
+        dest_station_id (number): the destination station id.
+        days (iterable): the days to search in order (datetime.datetime), the routes departing before their time are
+            not available.
+        executor (concurrent.futures.Executor): the executor fetching the days.
+        window (number): Optional. the amount of days fetched at the same time.
+        allow_stale (bool): Optional. whether an expired cached day can be used, see `get_day_timetable`.
+        on_fetched (callable): Optional. called with the day, its available routes and the seconds it took to get
+            them, for every fetched day in order.
+
+    Returns:
+        tuple. the list of available routes and their day, None if none of the days has routes.
+
+    Raises:
+        AttributeError: If some of the parameters are wrong.
+        ValueError: The result from the server is missing.
+        RailServerUnavailableError: The rail server is not responding.
+    """
+    days = iter(days)
+    futures = deque()
+
+    def fetch_next_day():
+        day = next(days, None)
+        if day is not None:
+            futures.append((day, executor.submit(_timed_available_routes,
+                                                 origin_station_id,
+                                                 dest_station_id,
+                                                 day,
+                                                 allow_stale)))
+
+    for _ in range(window):
+        fetch_next_day()
 
-    url = ("https://www.rail.co.il/apiinfo/api/Plan/GetRoutes"
-           f"?OId={origin_station_id}"
-           f"&TId={dest_station_id}"
-           f"&Date={date_formatted}"
-           f"&Hour=0000"
-           "&isGoing=true"
-           f"&c={str(round(datetime.datetime.now().timestamp(), 3)).replace('.', '')}")
-    res = requests.get(url)
     try:
-        body = res.json()
+        while len(futures) > 0:
+            day, future = futures.popleft()
+            routes, elapsed = future.result()
+            if on_fetched is not None:
+                on_fetched(day, routes, elapsed)
 
-    except JSONDecodeError:
-        raise AttributeError('No JSON received. some of the request parameters might be wrong')
+            if len(routes) > 0:
+                return routes, day
+
+            fetch_next_day()
+
+        return None
+
+    finally:
+        # The days after the first day with routes (or after an error) are not needed anymore
+        for _, future in futures:
+            future.cancel()
 
-    if 'Data' not in body or 'Routes' not in body['Data']:
-        raise ValueError('Received JSON has no attribute "Data" or "Routes"')
 
-    for item in body['Data']['Routes']:
-        for item2 in item['Train']:
-            yield Train.from_json(item2)
+def _timed_available_routes(origin_station_id, dest_station_id, date, allow_stale):
+    start = time.perf_counter()
+    routes = list(get_available_routes(origin_station_id, dest_station_id, date, allow_stale))
+    return routes, time.perf_counter() - start
 
 
-def get_available_trains(origin_station_id, dest_station_id, date: datetime.datetime = None):
+def get_all_trains_for_today(origin_station_id, dest_station_id, date: datetime.date = None, allow_stale=False):
+    """Get a generator of all the trains that were available today sorted by departure, from 00:00 to 00:00.
+
+    The trains of all the routes are flattened, use `get_all_routes_for_today` to know which trains are connected.
+
+    Args:
+        origin_station_id (number): the origin station id.
+        dest_station_id (number): the destination station id.
+        date (datetime.datetime): Optional. the date of the day, the time does not matter. if not supplied the date
+            is today.
+        allow_stale (bool): Optional. whether an expired cached day can be used, see `get_day_timetable`.
+
+    Yields:
+        Train. train object contains all the data of the train.
+
+    Raises:
+        AttributeError: If some of the parameters are wrong.
+        ValueError: The result from the server is missing.
+    """
+    yield from get_day_timetable(origin_station_id, dest_station_id, date, allow_stale=allow_stale).trains
+
+
+def get_available_trains(origin_station_id, dest_station_id, date: datetime.datetime = None, allow_stale=False):
     """Get a generator of all the trains that are available from the current date and on.
 
     Args:
@@ -579,6 +1276,7 @@ def get_available_trains(origin_station_id, dest_station_id, date: datetime.date
         dest_station_id (number): the destination station id.
         date (datetime.datetime): Optional. the day and time to get ongoing trains and on. if not supplied the date
             is now.
+        allow_stale (bool): Optional. whether an expired cached day can be used, see `get_day_timetable`.
 
     Yields:
         Train. train object contains all the data of the train.
@@ -586,9 +1284,7 @@ def get_available_trains(origin_station_id, dest_station_id, date: datetime.date
     if date is None:
         date = datetime.datetime.now()
 
-    for train in get_all_trains_for_today(origin_station_id, dest_station_id, date.date()):
-        if train.departure_datetime >= date:
-            yield train
+    yield from get_day_timetable(origin_station_id, dest_station_id, date.date(), allow_stale).trains_after(date)
 
 
 def get_first_available_train(origin_station_id, dest_station_id, date):
@@ -606,14 +1302,18 @@ def get_first_available_train(origin_station_id, dest_station_id, date):
     Raises:
         RuntimeError: if no trains were available for that date.
     """
-    now = datetime.datetime.now()
-    trains = get_available_trains(origin_station_id, dest_station_id, date=date)
-    trains = sorted(list(trains), key=attrgetter('departure_datetime'))
-    trains = [train for train in trains if train.departure_datetime > now]
-    if len(trains) == 0:
+    if date is None:
+        date = datetime.datetime.now()
+
+    return _first_available_train(get_day_timetable(origin_station_id, dest_station_id, date.date()), date)
+
+
+def _first_available_train(timetable, date):
+    train = timetable.first_available_train(date)
+    if train is None:
         raise RuntimeError('No trains available found in that time')
 
-    return trains[0]
+    return train
 
 
 def request_train(user_id,
@@ -622,7 +1322,7 @@ def request_train(user_id,
                   dest_station_id=None,
                   time_for_request: datetime.datetime = None,
                   train_instance=None,
-                  image_dest='image.jpeg'):
+                  image_dest=None):
     """Get a QR code for a specific train.
 
     Args:
@@ -634,7 +1334,11 @@ def request_train(user_id,
             is now.
         train_instance (Train): Optional. can be passed instead of origin_station_id, dest_station_id and
             time_for_request.
-        image_dest (str): Optional. path where to save the QR code image.
+        image_dest (str): Optional. path where to save the QR code image. if not supplied the image is returned in
+            memory without touching the disk.
+
+    Returns:
+        io.BytesIO / str. the QR code jpeg image, or the path it was saved to if image_dest is supplied.
 
     Note:
         Either supply origin_station_id, dest_station_id and time_for_request or train_instance. not both and not
@@ -643,18 +1347,9 @@ def request_train(user_id,
     Raises:
         AttributeError: some arguments must be wrong.
         ValueError: No barcode image received.
+        RailServerUnavailableError: The rail server is not responding.
         RuntimeError: some other error.
     """
-    url = ("https://www.rail.co.il/taarif//_layouts/15/SolBox.Rail.FastSale/ReservedPlaceHandler.ashx"
-           "?numSeats=1"
-           f"&smartCard={user_id}"
-           f"&mobile={MOBILE_PLACEHOLDER}"
-           f"&userEmail={email}"
-           "&method=MakeVoucherSeatsReservation"
-           "&IsSendEmail=true"
-           "&source=1"
-           "&typeId=1")
-
     if train_instance is None and (origin_station_id is None or dest_station_id is None or time_for_request is None):
         raise ValueError("Either train_json should be supplied or (origin_station_id, dest_station_id, "
                          "time_for_request)")
@@ -665,7 +1360,61 @@ def request_train(user_id,
     else:
         train = get_first_available_train(origin_station_id, dest_station_id, time_for_request)
 
-    payload = [{
+    res = client.post(_voucher_url(user_id, email), data=json.dumps(_voucher_payload(train)))
+    try:
+        body = res.json()
+
+    except JSONDecodeError:
+        raise AttributeError('No JSON received, some of the arguments must be wrong')
+
+    return _save_barcode_image(_barcode_image_from_voucher_body(body), image_dest)
+
+
+def request_route(user_id, route, email='', executor=None):
+    """Get a QR code for every train of a route, the trains are ordered concurrently.
+
+    Args:
+        user_id (str): user ID number.
+        route (Route): the route to order.
+        email (str): Optional. the email the server will send verification mail and cancellation link.
+        executor (concurrent.futures.Executor): Optional. executor to order the trains on, by default a thread per
+            train is used.
+
+    Returns:
+        list. for every train of the route (in order), the QR code image (io.BytesIO) or the exception raised while
+        ordering it, so the vouchers that were ordered are not lost when another train fails.
+    """
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=len(route.trains)) as route_executor:
+            return request_route(user_id, route, email, executor=route_executor)
+
+    futures = [executor.submit(request_train, user_id=user_id, email=email, train_instance=train)
+               for train in route.trains]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+
+        except Exception as e:
+            results.append(e)
+
+    return results
+
+
+def _voucher_url(user_id, email):
+    return (f"{RAIL_SERVER_URL}/taarif//_layouts/15/SolBox.Rail.FastSale/ReservedPlaceHandler.ashx"
+            "?numSeats=1"
+            f"&smartCard={user_id}"
+            f"&mobile={MOBILE_PLACEHOLDER}"
+            f"&userEmail={email}"
+            "&method=MakeVoucherSeatsReservation"
+            "&IsSendEmail=true"
+            "&source=1"
+            "&typeId=1")
+
+
+def _voucher_payload(train):
+    return [{
         'TrainDate': f"{train.arrival_date} 00:00:00",
         'destinationStationId': stations_info[train.destination_station_id]['ID'],
         'destinationStationHe': '',
@@ -682,13 +1431,8 @@ def request_train(user_id,
         'TrainOrder': 1
     }]
 
-    res = requests.post(url, data=json.dumps(payload), proxies=proxies, timeout=60)
-    try:
-        body = res.json()
-
-    except JSONDecodeError:
-        raise AttributeError('No JSON received, some of the arguments must be wrong')
 
+def _barcode_image_from_voucher_body(body):
     if 'BarcodeImage' not in body:
         raise ValueError('Cannot find BarcodeImage in the response JSON')
 
@@ -696,7 +1440,13 @@ def request_train(user_id,
     if image_b64_raw is None:
         raise TrainSeatError({body["voutcher"]["ErrorDescription"]})
 
-    image_binary = base64.b64decode(image_b64_raw)
+    return base64.b64decode(image_b64_raw)
+
+
+def _save_barcode_image(image_binary, image_dest=None):
+    if image_dest is None:
+        return io.BytesIO(image_binary)
+
     with open(image_dest, 'wb') as f:
         f.write(image_binary)
 
@@ -0,0 +1,227 @@
+import json
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+users_registry_flush_seconds = metrics.Histogram('users_registry_flush_seconds',
+                                                 'Duration of the writes of the buffered user registrations')
+
+# Firebase orders the keys that are 32 bit integers first (numerically), and then the other keys as strings.
+MAX_INT_KEY = 2 ** 31 - 1
+
+
+def firebase_key_order(key):
+    """Sort key of a firebase key, the same order as `orderBy="$key"` queries."""
+    if key.isdigit() and int(key) <= MAX_INT_KEY:
+        return 0, int(key), ''
+
+    return 1, 0, key
+
+
+class UsersRegistry:
+    """Local index of the users who started the bot, synced from firebase a shard at a time.
+
+    The users are kept in firebase under `/users/<user id>: username`, and the users who blocked the bot (or deleted
+    their account) under `/inactive_users/<user id>: timestamp`. The index is filled page by page the first time the
+    users are iterated, later iterations only fetch the users added after the last known one.
+
+    New and inactive users are buffered and written to firebase together, in a single multi-path update, by
+    :meth:`flush` (e.g. every few seconds from the job queue) or as soon as `max_pending` changes are waiting. A user
+    registered a few times before the write is written once.
+
+    Attributes:
+        firebase (firebase.FirebaseApplication): the db the users are kept in.
+        shard_size (number): Optional. the amount of users fetched and iterated at a time.
+        max_pending (number): Optional. the amount of buffered users that triggers a write.
+    """
+    USERS_KEY = 'users'
+    INACTIVE_USERS_KEY = 'inactive_users'
+
+    def __init__(self, firebase, shard_size=1000, max_pending=500):
+        self.firebase = firebase
+        self.shard_size = shard_size
+        self.max_pending = max_pending
+        self._users = {}
+        self._sorted_ids = None
+        self._inactive_ids = None
+        self._synced = False
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        metrics.CallbackMetric('users_registry_size', 'Users in the local users index, by state',
+                               lambda: {('active',): len(self._users) - len(self._inactive_ids or ()),
+                                        ('inactive',): len(self._inactive_ids or ())},
+                               label_names=('state',))
+        metrics.CallbackMetric('users_registry_pending', 'Changes of users waiting to be written to firebase',
+                               lambda: len(self._pending))
+
+    @property
+    def inactive_ids(self):
+        with self._lock:
+            if self._inactive_ids is None:
+                # shallow, only the keys are needed
+                inactive = self.firebase.get(f'/{self.INACTIVE_USERS_KEY}', None, params={'shallow': 'true'})
+                self._inactive_ids = set(inactive or ())
+
+            return self._inactive_ids
+
+    def add(self, user_id, username):
+        """Register a user who started the bot, a user who was inactive becomes active again.
+
+        The user is written to firebase on the next :meth:`flush`.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            self._add_to_index({user_id: username})
+            reactivated = user_id in self.inactive_ids
+            self._inactive_ids.discard(user_id)
+
+        changes = {f'{self.USERS_KEY}/{user_id}': username}
+        if reactivated:
+            changes[f'{self.INACTIVE_USERS_KEY}/{user_id}'] = None
+
+        self._buffer(changes)
+
+    def _buffer(self, changes):
+        with self._pending_lock:
+            self._pending.update(changes)
+            full = len(self._pending) >= self.max_pending
+
+        if full:
+            self.flush(blocking=False)
+
+    def flush(self, context=None, blocking=True):
+        """Write the buffered users to firebase in one update, can be used as a JobQueue callback.
+
+        If the write fails the users are kept buffered and written on the next flush.
+
+        Args:
+            context (telegram.ext.CallbackContext): Optional. ignored, the context of the job.
+            blocking (bool): Optional. whether to wait for a flush that is already running, or return right away.
+        """
+        if not self._flush_lock.acquire(blocking):
+            return
+
+        try:
+            with self._pending_lock:
+                changes, self._pending = self._pending, {}
+
+            if len(changes) == 0:
+                return
+
+            try:
+                with users_registry_flush_seconds.time():
+                    self.firebase.patch('/', changes)
+
+            except Exception:
+                logger.exception(f'Failed to write {len(changes)} users changes, retrying on the next flush')
+                with self._pending_lock:
+                    # changes made since are newer
+                    self._pending = {**changes, **self._pending}
+
+        finally:
+            self._flush_lock.release()
+
+    def mark_inactive(self, user_id):
+        """Skip a user who can't be messaged anymore (blocked the bot / deleted the chat) from now on."""
+        user_id = str(user_id)
+        with self._lock:
+            if user_id in self.inactive_ids:
+                return
+
+            self._inactive_ids.add(user_id)
+
+        # buffered as well, so it is not overwritten by a buffered reactivation of the user
+        self._buffer({f'{self.INACTIVE_USERS_KEY}/{user_id}': int(time.time())})
+
+    def iter_shards(self, after=None):
+        """Iterate the active users, `shard_size` users at a time, in a stable order.
+
+        Args:
+            after (str): Optional. the id of the user to start after (e.g. the last user of an interrupted iteration).
+
+        Yields:
+            list. (user id, username) of the active users of the next shard.
+        """
+        # the pages fetched from firebase should include the buffered users
+        self.flush()
+        if not self._synced:
+            yield from self._iter_remote_shards(after)
+            return
+
+        self._fetch_users_after(self._last_id())
+        with self._lock:
+            ids = self._sorted_index()
+
+        start = 0
+        if after is not None:
+            # first id ordered after `after`
+            after_order = firebase_key_order(after)
+            start = next((i for i, user_id in enumerate(ids) if firebase_key_order(user_id) > after_order), len(ids))
+
+        for i in range(start, len(ids), self.shard_size):
+            shard = [(user_id, self._users[user_id]) for user_id in ids[i:i + self.shard_size]
+                     if user_id not in self.inactive_ids]
+            if len(shard) > 0:
+                yield shard
+
+    def _iter_remote_shards(self, after):
+        last_id = after
+        while True:
+            ids, page = self._fetch_page(last_id)
+            shard = [(user_id, page[user_id]) for user_id in ids if user_id not in self.inactive_ids]
+            if len(shard) > 0:
+                yield shard
+
+            if len(ids) < self.shard_size:
+                break
+
+            last_id = ids[-1]
+
+        if after is None:
+            self._synced = True
+
+    def _fetch_users_after(self, last_id):
+        while True:
+            ids, _ = self._fetch_page(last_id)
+            if len(ids) < self.shard_size:
+                return
+
+            last_id = ids[-1]
+
+    def _fetch_page(self, last_id):
+        """Fetch the next `shard_size` users after `last_id` into the index, return their sorted ids and the page."""
+        params = {'orderBy': '"$key"', 'limitToFirst': self.shard_size}
+        if last_id is not None:
+            # startAt is inclusive, fetch one more user and drop `last_id`
+            params.update(startAt=json.dumps(last_id), limitToFirst=self.shard_size + 1)
+
+        page = self.firebase.get(f'/{self.USERS_KEY}', None, params=params) or {}
+        page.pop(last_id, None)
+        ids = sorted(page, key=firebase_key_order)[:self.shard_size]
+        with self._lock:
+            self._add_to_index(page)
+
+        return ids, page
+
+    def _add_to_index(self, users):
+        new_ids = users.keys() - self._users.keys()
+        self._users.update(users)
+        if len(new_ids) > 0:
+            self._sorted_ids = None
+
+    def _sorted_index(self):
+        if self._sorted_ids is None:
+            self._sorted_ids = sorted(self._users, key=firebase_key_order)
+
+        return self._sorted_ids
+
+    def _last_id(self):
+        with self._lock:
+            ids = self._sorted_index()
+            return ids[-1] if len(ids) > 0 else None
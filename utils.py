@@ -1,4 +1,5 @@
 import json
+from urllib.parse import unquote
 
 
 def flatten(deep_list):
@@ -13,36 +14,106 @@ def flatten(deep_list):
     return final_list
 
 
-def enocde_conversations(conversations):
+# Characters firebase does not allow in keys, and the escape character itself
+FIREBASE_KEY_ESCAPED_CHARACTERS = '%.$#[]/'
+
+
+def encode_firebase_key(key):
+    """Encode a string (e.g. a saved train label) to a valid firebase key, escaping the characters firebase does not
+    allow in keys as %XX. Use :attr:`decode_firebase_key` to decode.
+
+    Args:
+        key (:obj:`str`): the string to encode (e.g. "עפולה ר.איתן - חיפה").
+
+    Returns:
+        :obj:`str`: the encoded key (e.g. "עפולה ר%2Eאיתן - חיפה").
+    """
+    return ''.join(f'%{ord(char):02X}' if char in FIREBASE_KEY_ESCAPED_CHARACTERS else char for char in key)
+
+
+def decode_firebase_key(encoded_key):
+    """Decode a key encoded by :attr:`encode_firebase_key`, keys without escaped characters are returned as is."""
+    return unquote(encoded_key)
+
+
+def enocde_conversations(conversations, changed_keys=None):
     """Helper method to encode a conversations dict (that uses tuples as keys) to a
     JSON-serializable way. Use :attr:`decode_conversations` to decode.
 
-    Since firebase does not support [ and ] characters, the json string is replaced with (, ) instead of [ and ].
+    The keys are encoded with :attr:`encode_conversation_key`.
 
     Args:
         conversations (:obj:`dict`): The conversations dict to transofrm to JSON.
+        changed_keys (:obj:`iterable`, optional): (handler name, key) of the changed entries, to encode only them
+            instead of the whole dict.
 
     Returns:
         :obj:`dict`: The JSON-serialized conversations dict
     """
-    tmp = {}
-    for handler, states in conversations.items():
-        tmp[handler] = {}
-        for key, state in states.items():
-            key_in_list_format = json.dumps(key)
-            # Converting to tuple format since firebase cannot handle [ and ]
-            key_in_tuple_format = key_in_list_format.replace("[", "(").replace("]", ")")
-            tmp[handler][key_in_tuple_format] = state
-    return tmp
+    if changed_keys is not None:
+        tmp = {}
+        for handler, key in changed_keys:
+            tmp.setdefault(handler, {})[encode_conversation_key(key)] = conversations.get(handler, {}).get(key)
+        return tmp
+
+    return {handler: {encode_conversation_key(key): state for key, state in states.items()}
+            for handler, states in conversations.items()}
+
+
+def encode_conversation_key(key):
+    """Encode a single conversation key (tuple) to the string used by :attr:`enocde_conversations`.
+
+    Keys of ints, like the (chat id, user id) keys of the conversation handlers, are joined with ":". Other keys fall
+    back to the legacy format, see :attr:`encode_legacy_conversation_key`.
+
+    Args:
+        key (:obj:`tuple`): the conversation key (e.g. (123, 456)).
+
+    Returns:
+        :obj:`str`: the encoded key (e.g. "123:456").
+    """
+    if len(key) == 2 and type(key[0]) is int and type(key[1]) is int:
+        return f'{key[0]}:{key[1]}'
+
+    if len(key) > 0 and all(type(item) is int for item in key):
+        return ':'.join(map(str, key))
+
+    return encode_legacy_conversation_key(key)
+
+
+def encode_legacy_conversation_key(key):
+    """Encode a conversation key (tuple) as a JSON list in parentheses (e.g. "(123, 456)").
+
+    Since firebase does not support [ and ] characters, the json string is replaced with (, ) instead of [ and ].
+    """
+    key_in_list_format = json.dumps(key)
+    # Converting to tuple format since firebase cannot handle [ and ]
+    return key_in_list_format.replace("[", "(").replace("]", ")")
+
+
+def is_legacy_conversation_key(encoded_key):
+    return encoded_key.startswith('(')
+
+
+def decode_conversation_key(encoded_key):
+    """Decode a conversation key encoded by :attr:`encode_conversation_key` (or in the legacy format) to a tuple."""
+    if encoded_key.startswith('('):
+        # The legacy format, replacing the 'tuple string' to a 'list string' (e.g. "(123, 456)" to "[123, 456]")
+        return tuple(json.loads(encoded_key.replace("(", "[").replace(")", "]")))
+
+    chat_id, _, user_id = encoded_key.partition(':')
+    if user_id != '' and ':' not in user_id:
+        return int(chat_id), int(user_id)
+
+    return tuple(map(int, encoded_key.split(':')))
 
 
 def decode_conversations(conversations_dict):
     """Helper method to decode a conversations dict (that uses tuples as keys) from a
     JSON-string created with :attr:`enocde_conversations`.
 
-    The received keys are strings which contain tuples. The function replaces the 'tuple string' to a 'list string' (
-    e.g. "(123, 456)" to "[123, 456]") which than can be decoded using json.
-    Then its converted back to tuples to its original form.
+    The received keys are strings encoded by :attr:`encode_conversation_key`, or in the legacy format (e.g.
+    "(123, 456)"), they are converted back to tuples to its original form.
 
     Args:
         json_string (:obj:`dict`): The conversations dict.
@@ -50,13 +121,5 @@ def decode_conversations(conversations_dict):
     Returns:
         :obj:`dict`: The conversations dict after decoding
     """
-    tmp = conversations_dict
-    conversations = {}
-    for handler, states in tmp.items():
-        conversations[handler] = {}
-        for key, state in states.items():
-            json_in_list_format = key.replace("(", "[").replace(")", "]")
-            key_in_list_format = json.loads(json_in_list_format)
-            key_in_tuple_format = tuple(key_in_list_format)
-            conversations[handler][key_in_tuple_format] = state
-    return conversations
\ No newline at end of file
+    return {handler: {decode_conversation_key(key): state for key, state in states.items()}
+            for handler, states in conversations_dict.items()}
@@ -0,0 +1,111 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+worker_pool_wait_seconds = metrics.Histogram('worker_pool_wait_seconds', 'Time tasks waited for a free worker',
+                                             ('pool',))
+worker_pool_rejected = metrics.Counter('worker_pool_rejected', 'Tasks rejected because the pool queue was full',
+                                       ('pool',))
+
+_worker_thread = threading.local()
+
+
+class PoolSaturatedError(Exception):
+    """The workers of a pool are busy and its queue is full."""
+
+
+def in_worker_thread():
+    """Whether the calling thread is a worker of one of the pools."""
+    return getattr(_worker_thread, 'pool', None) is not None
+
+
+class WorkerPool:
+    """Thread pool with a bounded queue, tasks submitted while the queue is full are rejected instead of waiting.
+
+    Attributes:
+        name (str): the name of the pool, its threads and metrics label.
+        max_workers (number): the amount of tasks running at the same time.
+        max_queued (number): the amount of tasks waiting for a free worker.
+    """
+
+    def __init__(self, name, max_workers, max_queued):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.busy = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'{name}-pool')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self):
+        return self._executor._work_queue.qsize()
+
+    def submit(self, function, *args, **kwargs):
+        """Run a function on one of the workers.
+
+        Returns:
+            concurrent.futures.Future. the result of the function.
+
+        Raises:
+            PoolSaturatedError: all the workers are busy and `max_queued` tasks are already waiting.
+        """
+        if not self._slots.acquire(blocking=False):
+            worker_pool_rejected.labels(pool=self.name).inc()
+            raise PoolSaturatedError(f'The {self.name} pool is saturated')
+
+        try:
+            return self._executor.submit(self._run, time.perf_counter(), function, args, kwargs)
+
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _run(self, submitted, function, args, kwargs):
+        worker_pool_wait_seconds.labels(pool=self.name).observe(time.perf_counter() - submitted)
+        _worker_thread.pool = self
+        with self._lock:
+            self.busy += 1
+
+        try:
+            return function(*args, **kwargs)
+
+        finally:
+            with self._lock:
+                self.busy -= 1
+
+            self._slots.release()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class WorkerPools:
+    """Separate worker pools for work depending on different services, so a slow service saturates only its own pool.
+
+    Args:
+        pools (dict): name of the pool to a tuple of (max workers, max queued tasks).
+    """
+
+    def __init__(self, pools):
+        self.pools = {name: WorkerPool(name, max_workers, max_queued)
+                      for name, (max_workers, max_queued) in pools.items()}
+        metrics.CallbackMetric('worker_pool_queue_size', 'Tasks waiting for a free worker',
+                               lambda: {(name,): pool.queued for name, pool in self.pools.items()},
+                               label_names=('pool',))
+        metrics.CallbackMetric('worker_pool_busy_workers', 'Workers running a task',
+                               lambda: {(name,): pool.busy for name, pool in self.pools.items()},
+                               label_names=('pool',))
+        metrics.CallbackMetric('worker_pool_saturation', 'Ratio of the pool capacity (workers and queue) in use',
+                               lambda: {(name,): (pool.busy + pool.queued) / (pool.max_workers + pool.max_queued)
+                                        for name, pool in self.pools.items()},
+                               label_names=('pool',))
+
+    def __getitem__(self, name):
+        return self.pools[name]
+
+    def shutdown(self, wait=True):
+        for pool in self.pools.values():
+            pool.shutdown(wait=wait)